@@ -0,0 +1,62 @@
+# training and prediction throughput of the disperseNN2 network, with the
+# default compiled step vs XLA (--jit_compile) and --steps_per_execution;
+# usage: python Benchmarks/training_step.py <threads> [<steps_per_execution>]
+
+import io
+import sys
+import time
+import contextlib
+import random
+import tempfile
+import numpy as np
+
+threads = int(sys.argv[1])
+steps_per_execution = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+# representative (n, num_snps, pairs) settings
+settings = [(10, 5000, 45), (50, 5000, 100), (100, 5000, 1000)]
+batch_size = 10
+num_batches = 20
+
+# (the disperseNN2 module reads its command line on import)
+out = tempfile.mkdtemp()
+sys.argv = ["disperseNN2", "--train", "--out", out, "--gpu", "-1",
+            "--threads", str(threads)]
+from dispersenn2 import disperseNN2  # noqa: E402
+
+args = disperseNN2.args
+disperseNN2.load_dl_modules()
+disperseNN2.configure_devices()
+tf = disperseNN2.tf
+
+print("n", "num_snps", "pairs", "mode",
+      "train examples/s", "predict examples/s", sep="\t")
+for n, num_snps, pairs in settings:
+    genos = np.random.randint(0, 3, (batch_size * num_batches, num_snps, n))
+    locs = np.random.uniform(size=(batch_size * num_batches, 2, n))
+    targets = np.random.normal(size=batch_size * num_batches)
+    for mode, jit, steps in [
+        ("default", False, 1),
+        ("steps_per_execution", False, steps_per_execution),
+        ("jit_compile", True, 1),
+        ("jit_compile+steps_per_execution", True, steps_per_execution),
+    ]:
+        args.n, args.num_snps = n, num_snps
+        args.pairs, args.pairs_encode = pairs, pairs
+        args.jit_compile, args.steps_per_execution = jit, steps
+        random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):  # (layer listing)
+            model = disperseNN2.load_network()[0]
+        data = tf.data.Dataset.from_tensor_slices(
+            ((genos.astype("int8"), locs), targets)
+        ).batch(batch_size).cache()
+        model.fit(data, epochs=1, verbose=0)  # (warm up: trace and compile)
+        start = time.perf_counter()
+        model.fit(data, epochs=2, verbose=0)
+        train_rate = 2 * len(targets) / (time.perf_counter() - start)
+        model.predict(data, verbose=0)
+        start = time.perf_counter()
+        model.predict(data, verbose=0)
+        predict_rate = len(targets) / (time.perf_counter() - start)
+        print(n, num_snps, pairs, mode, round(train_rate, 1),
+              round(predict_rate, 1), sep="\t", flush=True)
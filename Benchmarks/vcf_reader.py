@@ -0,0 +1,78 @@
+# time and peak memory for reading an empirical vcf: the original
+# line-by-line reader, the chunked reader (read_vcf), and the reservoir
+# sampled draw of num_snps sites (vcf2genos);
+# usage: python Benchmarks/vcf_reader.py <vcf> <n> <num_snps> <phase>
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+import numpy as np
+from dispersenn2.process_input import read_vcf, vcf2genos
+
+vcf_path = sys.argv[1]
+n = int(sys.argv[2])
+num_snps = int(sys.argv[3])
+phase = int(sys.argv[4])
+
+
+# the original reader, without the snp draw (plain text vcfs only)
+def line_reader(vcf_path, n, phase):
+    geno_mat = []
+    vcf = open(vcf_path, "r")
+    for line in vcf:
+        if line[0:2] == "##":
+            pass
+        elif line[0] == "#":
+            header = line.strip().split("\t")
+            if n is None:  # option for getting sample size from vcf
+                n = len(header) - 9
+        else:
+            newline = line.strip().split("\t")
+            genos = []
+            for field in range(9, len(newline)):
+                geno = newline[field].split(":")[0].split("/")
+                geno = [int(geno[0]), int(geno[1])]
+                if phase == 1:
+                    genos.append(sum(geno))
+                elif phase == 2:
+                    genos.append(geno[0])
+                    genos.append(geno[1])
+            for i in range((n * phase) - len(genos)):  # pad with 0s
+                genos.append(0)
+            geno_mat.append(genos)
+    vcf.close()
+    return np.array(geno_mat)
+
+
+def trial(reader, conn):
+    start = time.perf_counter()
+    if reader == "vcf2genos":
+        geno_mat = vcf2genos(vcf_path, n, num_snps, phase)
+    elif reader == "read_vcf":
+        geno_mat = read_vcf(vcf_path, n, phase)
+    else:
+        geno_mat = line_reader(vcf_path, n, phase)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    conn.send((seconds, peak, geno_mat.shape))
+    conn.close()
+
+
+print("vcf", round(os.path.getsize(vcf_path) / 1e6, 1), "MB", sep="\t")
+print("reader", "seconds", "peak MB", "shape", sep="\t")
+readers = ["read_vcf", "vcf2genos"]
+if not vcf_path.endswith(".gz"):
+    readers = ["line_reader"] + readers
+for reader in readers:
+    # (each reader in a fresh child process, so peak memory is its own)
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.get_context("fork").Process(
+        target=trial, args=(reader, child)
+    )
+    process.start()
+    seconds, peak, shape = parent.recv()
+    process.join()
+    print(reader, round(seconds, 2), round(peak, 1), shape, sep="\t",
+          flush=True)
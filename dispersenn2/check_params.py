@@ -30,13 +30,24 @@ def check_params(args):
         and args.preprocess is False
         and args.plot_history is False
         and args.empirical is None
+        and args.quantize is False
+        and args.autotune is None
     ):
         print(
             "either --help, --train, --predict, --preprocess,\
-            --empirical,  or --plot_history"
+            --empirical, --quantize, --autotune, or --plot_history"
         )
         exit()
-    if args.train is True or args.predict is True or args.preprocess is True:
+    if args.autotune is not None:
+        if (args.n is None or args.num_snps is None) and args.out is None:
+            print("specify --n and --num_snps, or --out with training params, \
+                  for --autotune")
+            exit()
+    if args.quantize is True and args.lite is None:
+        print("specify the precision to quantize to via --lite")
+        exit()
+    if (args.train is True or args.predict is True or args.preprocess is True
+            or args.quantize is True):
         if args.out is None:
             print("specify output directory --out")
             exit()
@@ -47,14 +58,31 @@ def check_params(args):
         if args.n is None:
             print("specify sample size via --n")
             exit()
-    if args.predict is True and args.empirical is None:
-        if args.num_pred is not None:
-            if args.num_pred % args.batch_size != 0:
-                print(
-                    "\n\npred sets each need to be divisible by batch_size; \
-                    otherwise some batches will have missing data\n\n"
-                )
-                exit()
+    if args.on_the_fly is True:
+        if args.tree_list is None or args.target_list is None:
+            print("--on_the_fly needs --tree_list and --target_list")
+            exit()
+        if args.num_snps is None or args.n is None:
+            print("--on_the_fly needs --num_snps and --n")
+            exit()
+        if args.tf_data is True:
+            print("--on_the_fly can't be combined with --tf_data")
+            exit()
+    if args.pack_genos is True and args.polarize == 1:
+        print("--pack_genos can't be combined with --polarize 1, \
+        since multi-allelic sites have genotypes above 1")
+        exit()
+    if args.workers is not None:
+        num_workers = len(args.workers.split(","))
+        if args.worker_index is None:
+            print("specify the index of this worker via --worker_index")
+            exit()
+        if args.on_the_fly is True:
+            print("--workers can't be combined with --on_the_fly")
+            exit()
+        if args.batch_size % num_workers != 0:
+            print("batch_size needs to be divisible by the number of workers")
+            exit()
     if args.edge_width != "0" and args.empirical is not None:
         print(
             "can't specify edge width and empirical locations; at least not \
@@ -1,13 +1,15 @@
 # data generator code for training disperseNN2
 
-import sys
 import numpy as np
 import tensorflow as tf
 import msprime
 import tskit
 import warnings
+from scipy.spatial import cKDTree
 from attrs import define
-from dispersenn2.read_input import parse_provenance
+from dispersenn2.read_input import parse_provenance, load_arrays
+from dispersenn2.process_input import unpack_genos, project_locs, task_seed
+from dispersenn2.recap_cache import cache_key, cache_load, cache_store
 import gc
 
 
@@ -35,9 +37,16 @@ class DataGenerator(tf.keras.utils.Sequence):
     grid_coarseness: int
     sample_grid: int
     empirical_locs: list
+    auto_mu: bool = False
+    recap_cache: str = None
+    recap_cache_size: float = None
+    resample: bool = False
+    empirical_latlon: list = None
 
     def __attrs_post_init__(self):
         "Initialize a few things"
+        self.shards = {}  # (memory-mapped shards, opened as needed)
+        self.epoch = -1
         self.on_epoch_end()
         np.random.seed(self.baseseed)
         warnings.simplefilter(
@@ -65,13 +74,13 @@ class DataGenerator(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         "Updates indexes after each epoch"
+        self.epoch += 1
         self.indexes = np.arange(len(self.list_IDs))
         if self.shuffle is True:
             np.random.shuffle(self.indexes)
 
     def cropper(self, ts, W, sample_width, edge_width, alive_inds):
         "Cropping the map, returning individuals inside sampling window"
-        cropped = []
         left_edge = np.random.uniform(
             low=edge_width, high=W - edge_width - sample_width
         )
@@ -81,96 +90,124 @@ class DataGenerator(tf.keras.utils.Sequence):
         )
         top_edge = bottom_edge + sample_width
 
-        for i in alive_inds:
-            ind = ts.individual(i)
-            loc = ind.location[0:2]
-            if (
-                loc[0] > left_edge
-                and loc[0] < right_edge
-                and loc[1] > bottom_edge
-                and loc[1] < top_edge
-            ):
-                cropped.append(i)
+        locs = ts.individuals_location[alive_inds, 0:2]
+        inside = (
+            (locs[:, 0] > left_edge)
+            & (locs[:, 0] < right_edge)
+            & (locs[:, 1] > bottom_edge)
+            & (locs[:, 1] < top_edge)
+        )
+        cropped = alive_inds[inside]
 
         return cropped
 
-    def sample_ind(self, ts, sampled_inds, W, i, j):
+    def grid_sample(self, ts, sampled_inds, W):
+        "Take the first individual from each grid square, repeatedly"
         bin_size = W / self.sample_grid
-        output_ind = None
-        for ind in sampled_inds:
-            indiv = ts.individual(ind)
-            loc = indiv.location[0:2]
-            if (
-                loc[0] > (i * bin_size)
-                and loc[0] < ((i + 1) * bin_size)
-                and loc[1] > (j * bin_size)
-                and loc[1] < ((j + 1) * bin_size)
-            ):
-                output_ind = ind
-                break
-        if (
-            output_ind is None
-        ):  # if no individuals in the current square, choose a random ind
-            output_ind = np.random.choice(sampled_inds, 1, replace=False)
-
-        return output_ind
-
-    def unpolarize(self, snp):
-        "Change 0,1 encoding to major/minor allele. Also filter no-biallelic"
-        alleles = {}
-        for i in range(self.n * 2):
-            a = snp[i]
-            if a not in alleles:
-                alleles[a] = 0
-            alleles[a] += 1
-        if len(alleles) == 2:
-            new_genotypes = []
-            major, minor = list(set(alleles))  # set() gives random order
-            if alleles[major] < alleles[minor]:
-                major, minor = minor, major
-            for i in range(self.n * 2):  # go back through, convert genotypes
-                a = snp[i]
-                if a == major:
-                    new_genotype = 0
-                elif a == minor:
-                    new_genotype = 1
-                new_genotypes.append(new_genotype)
-        else:
-            new_genotypes = False
+        num_squares = self.sample_grid**2
+        locs = ts.individuals_location[sampled_inds, 0:2]
+
+        # assign individuals to squares; boundaries belong to no square
+        bins = np.floor(locs / bin_size).astype(int)
+        bins -= (locs <= bins * bin_size).astype(int)  # (float round-off)
+        bins += (locs >= (bins + 1) * bin_size).astype(int)
+        inside = np.all(
+            (locs > bins * bin_size)
+            & (locs < (bins + 1) * bin_size)
+            & (bins >= 0)
+            & (bins < self.sample_grid),
+            axis=1,
+        )
+        squares = np.where(inside,
+                           bins[:, 0] * self.sample_grid + bins[:, 1],
+                           num_squares)
+
+        # queue of individuals for each square, in their original order
+        order = np.argsort(squares, kind="stable")
+        bounds = np.searchsorted(squares[order], np.arange(num_squares + 1))
+        heads = bounds[:-1].copy()
+        available = np.ones(len(sampled_inds), dtype=bool)
+        keep_indivs = []
+        for r in range(
+            int(np.ceil(self.n / num_squares))
+        ):  # sampling from each square multiple times until >= n samples
+            for square in range(num_squares):
+                while (
+                    heads[square] < bounds[square + 1]
+                    and not available[order[heads[square]]]
+                ):  # skip individuals already taken at random
+                    heads[square] += 1
+                if heads[square] < bounds[square + 1]:
+                    new_guy = order[heads[square]]
+                    heads[square] += 1
+                else:  # if no individuals in the square, choose a random ind
+                    new_guy = np.random.choice(
+                        np.flatnonzero(available), 1, replace=False
+                    )[0]
+                keep_indivs.append(sampled_inds[new_guy])
+                available[new_guy] = False  # avoid sampling same guy
+
+        return keep_indivs
+
+    def unpolarize(self, snps):
+        "Change 0,1 encoding to major/minor allele. Also flag bi-allelic sites"
+        low = np.min(snps, axis=1, keepdims=True)
+        high = np.max(snps, axis=1, keepdims=True)
+        is_high = snps == high
+        biallelic = np.all(is_high | (snps == low), axis=1) & (
+            low[:, 0] != high[:, 0]
+        )
+        high_counts = np.sum(is_high, axis=1)
+        minor_is_high = (
+            high_counts <= snps.shape[1] - high_counts
+        )  # (ties go to the lower allele as major, like set() order did)
+        new_genotypes = np.where(minor_is_high[:, None], is_high, ~is_high)
+
+        return biallelic, new_genotypes.astype(np.int8)
+
+    def decode_sites(self, ts, site_ids):
+        "Genotypes for a sorted subset of sites, skipping all other sites"
+        geno_mat = np.empty((len(site_ids), ts.num_samples), dtype=np.int8)
+        variant = tskit.Variant(ts)
+        for i, site_id in enumerate(site_ids):
+            variant.decode(site_id)
+            geno_mat[i] = variant.genotypes
 
-        return new_genotypes
+        return geno_mat
 
     def empirical_sample(self, ts, sampled_inds, n, N, W):
+        "Greedy nearest-individual matching, without replacement"
         locs = np.array(self.empirical_locs)
         np.random.shuffle(locs)
-        indiv_dict = {}  # tracking which indivs have been picked up already
-        for i in sampled_inds:
-            indiv_dict[i] = 0
+        tree = cKDTree(ts.individuals_location[sampled_inds, 0:2])
+
+        # k nearest individuals for every location at once (ties -> low index)
+        k = min(N, 16)
+        dists, neighbors = tree.query(locs[0:n], k=[*range(1, k + 1)])
+        order = np.lexsort((neighbors, dists), axis=-1)
+        neighbors = np.take_along_axis(neighbors, order, axis=-1)
+
+        taken = np.zeros(N, dtype=bool)  # which indivs were picked up already
         keep_indivs = []
         for pt in range(n):  # for each sampling location
-            dists = {}
-            for i in indiv_dict:
-                ind = ts.individual(i)
-                loc = ind.location[0:2]
-                d = ((loc[0] - locs[pt, 0]) ** 2
-                     + (loc[1] - locs[pt, 1]) ** 2) ** (
-                         1 / 2
-                     )
-                dists[d] = i  # see what I did there?
-            nearest = dists[min(dists)]
-            ind = ts.individual(nearest)
-            loc = ind.location[0:2]
-            keep_indivs.append(nearest)
-            del indiv_dict[nearest]
+            candidates = neighbors[pt][~taken[neighbors[pt]]]
+            search = k
+            while len(candidates) == 0:  # the k nearest were all taken
+                search = min(N, search * 4)
+                d, nbrs = tree.query(locs[pt], k=[*range(1, search + 1)])
+                nbrs = nbrs[np.lexsort((nbrs, d))]
+                candidates = nbrs[~taken[nbrs]]
+            nearest = candidates[0]
+            keep_indivs.append(sampled_inds[nearest])
+            taken[nearest] = True
 
         return keep_indivs
 
-    def sample_ts(self, filepath, seed):
-        "The meat: load in and fully process a tree sequence"
+    def load_ts(self, filepath, seed):
+        "Load in a tree sequence, recapitate if needed"
 
         # read input
         ts = tskit.load(filepath)
-        np.random.seed(seed)
 
         # grab map width and sigma from provenance
         W = parse_provenance(ts, "W")
@@ -180,22 +217,43 @@ class DataGenerator(tf.keras.utils.Sequence):
             edge_width = float(self.edge_width)
 
         # recapitate
-        alive_inds = []
-        for i in ts.individuals():
-            alive_inds.append(i.id)
-        if self.recapitate == "True":
-            Ne = len(alive_inds)
-            if ts.num_populations > 1:
-                ts = ts.simplify()  # gets rid of weird, extraneous populations
-            demography = msprime.Demography.from_tree_sequence(ts)
-            demography[0].initial_size = Ne
-            ts = msprime.sim_ancestry(
-                initial_state=ts,
-                recombination_rate=self.rho,
-                demography=demography,
-                start_time=ts.metadata["SLiM"]["generation"],
-                random_seed=seed,
-            )
+        alive_inds = np.arange(ts.num_individuals)
+        if self.recapitate is True or self.recapitate == "True":
+            recapitated = None
+            if self.recap_cache is not None:
+                key = cache_key(filepath, self.rho, seed)
+                recapitated = cache_load(self.recap_cache, key)
+            if recapitated is None:
+                Ne = len(alive_inds)
+                if ts.num_populations > 1:
+                    ts = ts.simplify()  # gets rid of extraneous populations
+                demography = msprime.Demography.from_tree_sequence(ts)
+                demography[0].initial_size = Ne
+                recapitated = msprime.sim_ancestry(
+                    initial_state=ts,
+                    recombination_rate=self.rho,
+                    demography=demography,
+                    start_time=ts.metadata["SLiM"]["generation"],
+                    random_seed=seed,
+                )
+                if self.recap_cache is not None:
+                    cache_store(self.recap_cache,
+                                key,
+                                recapitated,
+                                self.recap_cache_size)
+            ts = recapitated
+
+        return ts, W, edge_width, alive_inds
+
+    def sample_ts(self, filepath, seed):
+        "The meat: load in and fully process a tree sequence"
+        ts, W, edge_width, alive_inds = self.load_ts(filepath, seed)
+
+        return self.sample_loaded_ts(ts, W, edge_width, alive_inds, seed)
+
+    def sample_loaded_ts(self, ts, W, edge_width, alive_inds, seed):
+        "Draw one sample (individuals + mutations) from a loaded tree sequence"
+        np.random.seed(seed)
 
         # crop map
         sample_width = W - (edge_width * 2)
@@ -205,25 +263,14 @@ class DataGenerator(tf.keras.utils.Sequence):
                                     edge_width,
                                     alive_inds)
         if len(sampled_inds) < self.n:
-            print("\tnot enough samples, killed while-loop after 100 loops",
-                  flush=True)
-            exit()
+            raise ValueError("not enough samples in the cropped map")
 
         # sample individuals
         if self.sample_grid is not None:
             if self.n < self.sample_grid**2:
-                print("your sample grid is too fine, \
-                not enough samples to fill it")
-                exit()
-            keep_indivs = []
-            for r in range(
-                int(np.ceil(self.n / self.sample_grid**2))
-            ):  # sampling from each square multiple times until >= n samples
-                for i in range(self.sample_grid):
-                    for j in range(self.sample_grid):
-                        new_guy = self.sample_ind(ts, sampled_inds, W, i, j)
-                        keep_indivs.append(new_guy)
-                        sampled_inds.remove(new_guy)  # avoid sampling same guy
+                raise ValueError("your sample grid is too fine, "
+                                 "not enough samples to fill it")
+            keep_indivs = self.grid_sample(ts, sampled_inds, W)
             keep_indivs = np.random.choice(
                 keep_indivs, self.n, replace=False
             )  # taking n from the >=n list
@@ -244,8 +291,17 @@ class DataGenerator(tf.keras.utils.Sequence):
 
         # mutate
         total_snps = self.num_snps
+        self.mu_used = None
         if self.skip_mutate is False:
-            mu = float(self.mu)
+            if self.auto_mu is True:  # expected sites = mu * branch length
+                target_sites = total_snps * 2
+                target_sites += 4 * np.sqrt(target_sites)  # (Poisson margin)
+                branch_length = ts.segregating_sites(
+                    mode="branch", span_normalise=False
+                )
+                mu = target_sites / branch_length
+            else:
+                mu = float(self.mu)
             ts = msprime.sim_mutations(
                 ts,
                 rate=mu,
@@ -267,9 +323,9 @@ class DataGenerator(tf.keras.utils.Sequence):
                     keep=True,
                 )
                 if counter == 10:
-                    print("\n\nsorry, Dude. Didn't generate enough snps. \n\n")
-                    sys.stdout.flush()
-                    exit()
+                    raise RuntimeError("sorry, Dude. "
+                                       "Didn't generate enough snps.")
+            self.mu_used = mu
 
         # grab spatial locations
         sample_dict = {}
@@ -298,57 +354,49 @@ class DataGenerator(tf.keras.utils.Sequence):
             locs[:, 0] *= x_range / y_range
         locs = locs.T
 
-        # grab genos
-        geno_mat0 = ts.genotype_matrix()
-
         # change 0,1 encoding to major/minor allele
         if self.polarize == 2:
             shuffled_indices = np.arange(ts.num_sites)
             np.random.shuffle(shuffled_indices)
-            geno_mat1 = []
-            snp_counter = 0
-            snp_index_map = {}
-            for s in range(total_snps):
-                new_genotypes = self.unpolarize(geno_mat0[shuffled_indices[s]])
-                if new_genotypes is not False:  # if bi-allelic, add in the snp
-                    geno_mat1.append(new_genotypes)
-                    snp_index_map[shuffled_indices[s]] = int(snp_counter)
-                    snp_counter += 1
+            keep_sites, keep_genos = [], []
+            snp_counter, s = 0, 0
             while (
                 snp_counter < total_snps
             ):  # likely need to replace a few non-biallelic sites
-                s += 1
-                new_genotypes = self.unpolarize(geno_mat0[shuffled_indices[s]])
-                if new_genotypes is not False:
-                    geno_mat1.append(new_genotypes)
-                    snp_index_map[shuffled_indices[s]] = int(snp_counter)
-                    snp_counter += 1
-            geno_mat0 = []
-            sorted_indices = list(snp_index_map)
-            sorted_indices.sort()
-            for snp in range(total_snps):
-                geno_mat0.append(geno_mat1[snp_index_map[sorted_indices[snp]]])
-            geno_mat0 = np.array(geno_mat0)
+                if s >= ts.num_sites:
+                    raise RuntimeError("not enough bi-allelic snps")
+                candidates = np.sort(
+                    shuffled_indices[s:s + total_snps - snp_counter]
+                )
+                s += len(candidates)
+                biallelic, geno_mat1 = self.unpolarize(
+                    self.decode_sites(ts, candidates)
+                )
+                keep_sites.append(candidates[biallelic])
+                keep_genos.append(geno_mat1[biallelic])
+                snp_counter += np.sum(biallelic)
+            keep_sites = np.concatenate(keep_sites)
+            geno_mat0 = np.concatenate(keep_genos)[
+                np.argsort(keep_sites)
+            ]  # first bi-allelic sites in shuffled order, in genome order
 
         # sample SNPs
         else:
             mask = [True] * total_snps + [False] * (ts.num_sites - total_snps)
             np.random.shuffle(mask)
-            geno_mat0 = geno_mat0[mask, :]
+            geno_mat0 = self.decode_sites(ts, np.flatnonzero(mask))
 
         # collapse genotypes, change to minor allele dosage (e.g. 0,1,2)
         if self.phase == 1:
-            geno_mat1 = np.zeros((total_snps, self.n))
-            for ind in range(self.n):
-                geno_mat1[:, ind] += geno_mat0[:, ind * 2]
-                geno_mat1[:, ind] += geno_mat0[:, ind * 2 + 1]
-            geno_mat0 = np.array(geno_mat1)  # (change variable name)
+            geno_mat0 = geno_mat0[:, 0::2] + geno_mat0[:, 1::2]
 
         # sample SNPs
         mask = [True] * self.num_snps + [False] * (total_snps - self.num_snps)
         np.random.shuffle(mask)
         geno_mat1 = geno_mat0[mask, :]
-        geno_mat2 = np.zeros((self.num_snps, self.n * self.phase))  # pad
+        geno_mat2 = np.zeros(
+            (self.num_snps, self.n * self.phase), dtype=np.int8
+        )  # pad
         geno_mat2[:, 0:self.n * self.phase] = geno_mat1
 
         # free memory
@@ -360,22 +408,123 @@ class DataGenerator(tf.keras.utils.Sequence):
 
         return geno_mat2, locs
 
+    def simulate_batch(self, list_IDs_temp):
+        "Sample a batch directly from the tree sequences"
+        X1 = np.empty((len(list_IDs_temp), self.num_snps, self.n),
+                      dtype="int8")
+        X2 = np.empty((len(list_IDs_temp), 2, self.n), dtype=float)
+        y = np.empty((len(list_IDs_temp),), dtype=float)
+        state = np.random.get_state()  # (sample_ts re-seeds numpy)
+        for i, ID in enumerate(list_IDs_temp):
+            tree_seed = task_seed(self.baseseed, ID)  # (fixed recapitation)
+            if self.resample is True:  # new draws each epoch
+                seed = task_seed(self.baseseed, self.epoch, ID)
+            else:
+                seed = tree_seed
+            ts, W, edge_width, alive_inds = self.load_ts(self.trees[ID],
+                                                         tree_seed)
+            if self.empirical_latlon is not None:
+                np.random.seed(seed)
+                self.empirical_locs = project_locs(self.empirical_latlon,
+                                                   W=W)
+            X1[i], X2[i] = self.sample_loaded_ts(ts, W, edge_width,
+                                                 alive_inds, seed)
+            y[i] = self.targets[ID]
+        np.random.set_state(state)
+
+        return X1, X2, y
+
+    def load_batch(self, list_IDs_temp):
+        "Load a batch of inputs and targets, before shuffling individuals"
+        if self.genos is None and self.trees is not None:
+            return self.simulate_batch(list_IDs_temp)
+        X1 = np.empty((len(list_IDs_temp), self.num_snps, self.n),
+                      dtype="int8")
+        X2 = np.empty((len(list_IDs_temp), 2, self.n), dtype=float)
+        y = np.empty((len(list_IDs_temp),), dtype=float)
+        if isinstance(self.genos, np.ndarray):  # one array for the whole split
+            rows = np.sort(list_IDs_temp)
+            if rows[-1] - rows[0] + 1 == len(rows):  # (view, without copying)
+                rows = slice(rows[0], rows[-1] + 1)
+            y[:] = self.targets[rows]
+            genos = self.genos[rows]
+            X2[:] = self.locs[rows]
+        else:
+            y[:] = load_arrays([self.targets[ID] for ID in list_IDs_temp],
+                               self.shards)
+            genos = np.stack(load_arrays(
+                [self.genos[ID] for ID in list_IDs_temp], self.shards
+            ))
+            X2[:] = load_arrays([self.locs[ID] for ID in list_IDs_temp],
+                                self.shards)
+        if genos.dtype == np.uint8:  # (bit-packed genotypes)
+            genos = unpack_genos(genos, self.phase, self.n * self.phase)
+        X1[:] = genos
+
+        return X1, X2, y
+
     def __data_generation(self, list_IDs_temp):
         "Generates data containing batch_size samples"
-        X1 = np.empty((self.batch_size, self.num_snps, self.n), dtype="int8")
-        X2 = np.empty((self.batch_size, 2, self.n), dtype=float)
-        y = np.empty((self.batch_size,), dtype=float)
         shuffled_indices = np.arange(self.n)
         np.random.shuffle(shuffled_indices)
-        for i, ID in enumerate(list_IDs_temp):
-            y[i] = np.load(self.targets[ID])
-            genomat = np.load(self.genos[ID])
-            genomat = genomat[
-                :, shuffled_indices
-            ]  # shuffe augments training set; especially pairs_encode<pairs
-            X1[i, :] = genomat
-            X2[i, :] = np.load(self.locs[ID])
-        # (unindent)
+        X1, X2, y = self.load_batch(list_IDs_temp)
+        X1 = X1[
+            :, :, shuffled_indices
+        ]  # shuffe augments training set; especially pairs_encode<pairs
         X = [X1, X2]
 
         return (X, y)
+
+    def dataset(self, seed=None, cache=None, drop_remainder=True):
+        "tf.data pipeline: batches loaded in parallel, with prefetching"
+        AUTOTUNE = tf.data.AUTOTUNE
+
+        def load(ids):
+            X1, X2, y = tf.numpy_function(
+                self.load_batch, [ids], [tf.int8, tf.float64, tf.float64]
+            )
+            X1.set_shape([None, self.num_snps, self.n])
+            X2.set_shape([None, 2, self.n])
+            y.set_shape([None])
+            return X1, X2, y
+
+        def shuffle_individuals(batch, batch_seed):
+            X1, X2, y = batch
+            shuffled_indices = tf.argsort(
+                tf.random.stateless_uniform(
+                    [self.n], seed=tf.stack([batch_seed, 0])
+                )
+            )  # (same permutation for each dataset in the batch)
+            X1 = tf.gather(X1, shuffled_indices, axis=2)
+            return (X1, X2), y
+
+        ids = tf.data.Dataset.from_tensor_slices(np.array(self.list_IDs))
+        if cache is None:
+            if self.shuffle is True:
+                ids = ids.shuffle(len(self.list_IDs), seed=seed)
+            batches = ids.batch(self.batch_size, drop_remainder).map(
+                load, num_parallel_calls=AUTOTUNE, deterministic=True
+            )
+        else:  # (cache loaded examples, then shuffle them)
+            examples = ids.batch(self.batch_size).map(
+                load, num_parallel_calls=AUTOTUNE, deterministic=True
+            ).unbatch()
+            if cache == "memory":
+                examples = examples.cache()
+            else:
+                examples = examples.cache(cache)
+            if self.shuffle is True:
+                buffer_size = len(self.list_IDs)
+                if cache != "memory":  # (bounded: the cache stays on disk)
+                    buffer_size = min(buffer_size, 64 * self.batch_size)
+                examples = examples.shuffle(buffer_size, seed=seed)
+            batches = examples.batch(self.batch_size, drop_remainder)
+        batches = tf.data.Dataset.zip(
+            (batches,
+             tf.data.Dataset.random(seed=seed,
+                                    rerandomize_each_iteration=True))
+        ).map(shuffle_individuals,
+              num_parallel_calls=AUTOTUNE,
+              deterministic=True)
+
+        return batches.prefetch(AUTOTUNE)
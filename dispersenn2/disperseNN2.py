@@ -4,15 +4,32 @@
 
 import os
 import sys
+import shutil
+import time
+import json
+import io
+import contextlib
+import resource
+import queue
 import random
 import argparse
-from sklearn.model_selection import train_test_split
+import multiprocessing
+from sklearn.model_selection import train_test_split, GroupShuffleSplit
 from dispersenn2.check_params import check_params
 from dispersenn2.read_input import list2dict
 from dispersenn2.read_input import read_list
 from dispersenn2.read_input import read_locs
 from dispersenn2.read_input import dict_from_preprocessed
-from dispersenn2.process_input import project_locs, vcf2genos
+from dispersenn2.read_input import tree_ids_from_preprocessed
+from dispersenn2.read_input import read_shard_index, read_manifest
+from dispersenn2.read_input import read_catalog
+from dispersenn2.read_input import read_packed, split_fingerprint
+from dispersenn2.process_input import project_locs, pack_genos
+from dispersenn2.process_input import read_vcf, sample_snps, vcf2genos
+from dispersenn2.process_input import task_seed, catalog_entry
+from dispersenn2.write_output import save_atomic, write_shard, pack_split
+from dispersenn2.write_output import manifest_line, open_manifest
+from dispersenn2.write_output import write_catalog, start_writer
 import gpustat
 import itertools
 import numpy as np
@@ -25,6 +42,8 @@ def load_dl_modules():  # load TF only if reading input is successfull
     import tensorflow as tf
     global DataGenerator
     from dispersenn2.data_generation import DataGenerator  # (loads TF)
+    global LiteModel, convert_lite
+    from dispersenn2.lite_model import LiteModel, convert_lite
 
     return
 
@@ -45,6 +64,20 @@ parser.add_argument(
     default=False,
     help="run prediction pipeline"
 )
+parser.add_argument(
+    "--quantize",
+    action="store_true",
+    default=False,
+    help="convert the trained model to a reduced-precision TFLite model \
+    (see --lite), and report its accuracy on the test set",
+)
+parser.add_argument(
+    "--lite",
+    default=None,
+    choices=["float16", "int8"],
+    help="precision of the TFLite model made by --quantize; with \
+    --predict, predict with that TFLite model instead",
+)
 parser.add_argument(
     "--empirical",
     default=None,
@@ -58,6 +91,13 @@ parser.add_argument(
     help="list of tree filepaths.",
     default=None
 )
+parser.add_argument(
+    "--catalog",
+    help="path to a catalog of the tree sequences in --tree_list (map width, \
+    sigma, number of individuals, SLiM generation, target); built on first \
+    use, then read instead of reopening the target files",
+    default=None,
+)
 parser.add_argument(
     "--edge_width",
     help="crop a fixed width from each edge of the map; \
@@ -71,6 +111,94 @@ parser.add_argument(
     type=int,
     help="number of SNPs",
 )
+parser.add_argument(
+    "--shard_size",
+    default=None,
+    type=int,
+    help="number of examples per shard file during preprocessing; \
+    by default each example is saved to its own files",
+)
+parser.add_argument(
+    "--pack_genos",
+    action="store_true",
+    default=False,
+    help="bit-pack the preprocessed genotypes: 1 bit per haplotype \
+    with --phase 2, 2 bits per genotype with --phase 1",
+)
+parser.add_argument(
+    "--memmap",
+    action="store_true",
+    default=False,
+    help="train/predict from one memory-mapped array per input, \
+    packing the preprocessed examples on first use",
+)
+parser.add_argument(
+    "--tf_data",
+    action="store_true",
+    default=False,
+    help="feed training through a tf.data pipeline that loads batches \
+    in parallel and prefetches them",
+)
+parser.add_argument(
+    "--cache_dataset",
+    default=None,
+    type=str,
+    help="with --tf_data, cache the loaded examples after the first epoch: \
+    'memory', or a file prefix for an on-disk cache",
+)
+parser.add_argument(
+    "--on_the_fly",
+    action="store_true",
+    default=False,
+    help="train by sampling directly from the tree sequences in --tree_list, \
+    with new spatial and mutation draws each epoch, instead of reading \
+    preprocessed data",
+)
+parser.add_argument(
+    "--sim_workers",
+    default=1,
+    type=int,
+    help="with --on_the_fly, number of worker processes sampling batches",
+)
+parser.add_argument(
+    "--queue_depth",
+    default=10,
+    type=int,
+    help="with --on_the_fly, max number of batches queued ahead of training",
+)
+parser.add_argument(
+    "--autotune",
+    default=None,
+    type=float,
+    help="RAM budget in GB: time a few training steps for candidate \
+    batch sizes and pairs_encode (unless given), and report the fastest \
+    setting that fits; applied to training if combined with --train",
+)
+parser.add_argument(
+    "--jit_compile",
+    action="store_true",
+    default=False,
+    help="compile the training and prediction steps with XLA",
+)
+parser.add_argument(
+    "--steps_per_execution",
+    default=1,
+    type=int,
+    help="number of batches to run per call into the compiled step",
+)
+parser.add_argument(
+    "--workers",
+    default=None,
+    type=str,
+    help="comma-separated host:port of every worker, for synchronous \
+    data-parallel training across processes or nodes",
+)
+parser.add_argument(
+    "--worker_index",
+    default=None,
+    type=int,
+    help="with --workers, index of this worker in the list (0 is the chief)",
+)
 parser.add_argument(
     "--num_pred",
     default=None,
@@ -89,6 +217,13 @@ parser.add_argument(
     default=1e-15,
     type=float,
 )
+parser.add_argument(
+    "--auto_mu",
+    action="store_true",
+    default=False,
+    help="set mu from the total branch length of each sample, so that a \
+    single round of mutation gives enough SNPs (ignores --mu)",
+)
 parser.add_argument(
     "--rho",
     help="recombination rate",
@@ -146,6 +281,18 @@ parser.add_argument(
     help="recapitate tree sequences",
     default=False,
 )
+parser.add_argument(
+    "--recap_cache",
+    help="directory for caching recapitated tree sequences between runs",
+    default=None,
+)
+parser.add_argument(
+    "--recap_cache_size",
+    help="max size of the recapitation cache in GB; the least recently \
+    used tree sequences are removed first. Default: no limit",
+    default=None,
+    type=float,
+)
 parser.add_argument(
     "--skip_mutate",
     action="store_true",
@@ -176,7 +323,8 @@ parser.add_argument(
     "--load_weights",
     default=None,
     type=str,
-    help="Path to a _weights.hdf5 file to load weight from previous run.",
+    help="Path to a _weights.hdf5 file to load weight from previous run, \
+    or to an exported model folder (_export).",
 )
 parser.add_argument(
     "--phase",
@@ -203,7 +351,8 @@ parser.add_argument(
     "--threads",
     default=1,
     type=int,
-    help="num threads.",
+    help="num threads. During preprocessing, the number of tree sequences \
+    processed in parallel.",
 )
 parser.add_argument(
     "--training_mean_sd", help="sigma mean and sd from training", default=None
@@ -232,6 +381,14 @@ parser.add_argument(
     type=int,
     default=None,
 )
+parser.add_argument(
+    "--encoder",
+    help="'pair' convolves the genotypes of each pair of individuals; \
+    'individual' convolves each individual once and builds the pair \
+    features from the per-individual embeddings (for large n)",
+    choices=["pair", "individual"],
+    default="pair",
+)
 parser.add_argument(
     "--pairs_encode",
     help="number of pairs (<= pairs_encode) to use for gradient \
@@ -253,7 +410,7 @@ if len(sys.argv) == 1:
     sys.exit(1)
 
 
-def load_network():
+def configure_devices():
     # set seed, gpu
     if args.seed is not None:
         tf.random.set_seed(args.seed)
@@ -286,6 +443,26 @@ def load_network():
     # for gpu in gpu_devices:
     #     tf.config.experimental.set_memory_growth(gpu, True)
 
+    return
+
+
+# multi-worker strategy for --workers, or None for a single process
+def load_strategy():
+    if args.workers is None:
+        return None
+    os.environ["TF_CONFIG"] = json.dumps({
+        "cluster": {"worker": args.workers.split(",")},
+        "task": {"type": "worker", "index": args.worker_index},
+    })
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    print("worker", args.worker_index, "of",
+          strategy.num_replicas_in_sync, flush=True)
+    return strategy
+
+
+# build and compile the network; with trained=True, load the weights saved
+# by training (or given by --load_weights)
+def load_network(trained=False):
     # update conv+pool iterations based on number of SNPs
     num_conv_iterations = int(np.floor(np.log10(args.num_snps)) - 1)
     if num_conv_iterations < 0:
@@ -323,32 +500,58 @@ def load_network():
     DENSE_0 = tf.keras.layers.Dense(128, activation="relu", name="DENSE_0")
     DENSE_1 = tf.keras.layers.Dense(128, activation="relu", name="DENSE_1")
 
-    # convolutions for each pair
-    hs = []
-    for comb in combinations:
-        h = tf.gather(geno_input, comb, axis=2)
-        locs = tf.gather(loc_input, comb, axis=2)
-        d = locs[:, :, 0] - locs[:, :, 1]
-        d = tf.norm(d, ord="euclidean", axis=1)
-        d = tf.keras.layers.Reshape((1,))(d)
-        if comb in combinations_encode:
+    # convolutions for each individual, once, stacked along the batch axis
+    if args.encoder == "individual":
+        h = tf.transpose(geno_input, [0, 2, 1])
+        h = tf.reshape(h, (-1, args.num_snps, 1))
+        for i in range(num_conv_iterations):
+            h = CONV_LAYERS[i](h)
+            h = tf.keras.layers.AveragePooling1D(pool_size=pooling_size)(h)
+        h = tf.keras.layers.Flatten()(h)
+        h = tf.keras.layers.Dense(128, activation="relu", name="EMBED")(h)
+        embeddings = tf.reshape(h, (-1, args.n, 128))
+
+    # convolutions for all pairs at once: the pairs are stacked along the
+    # batch axis, so the shared layers are applied once per group of pairs
+    def encode_pairs(pairs):
+        if args.encoder == "individual":  # (symmetric in the two individuals)
+            e = tf.gather(embeddings, pairs, axis=1)  # (batch, pairs, 2, 128)
+            h = tf.keras.layers.concatenate([e[:, :, 0] + e[:, :, 1],
+                                             tf.abs(e[:, :, 0] - e[:, :, 1])])
+        else:
+            h = tf.gather(geno_input, pairs, axis=2)  # (batch, snps, pairs, 2)
+            h = tf.transpose(h, [0, 2, 1, 3])
+            h = tf.reshape(h, (-1, args.num_snps, 2))
             for i in range(num_conv_iterations):
                 h = CONV_LAYERS[i](h)
-                h = tf.keras.layers.AveragePooling1D(pool_size=pooling_size)(h)
+                h = tf.keras.layers.AveragePooling1D(
+                    pool_size=pooling_size
+                )(h)
             h = tf.keras.layers.Flatten()(h)
-            h = tf.keras.layers.concatenate([h, d])
-            h = DENSE_0(h)
-        else:  # cut gradient tape on some pairs to save memory
-            for i in range(num_conv_iterations):
-                h = tf.stop_gradient(CONV_LAYERS[i](h))
-                h = tf.keras.layers.AveragePooling1D(pool_size=pooling_size)(h)
-            h = tf.keras.layers.Flatten()(h)
-            h = tf.keras.layers.concatenate([h, d])
-            h = tf.stop_gradient(DENSE_0(h))
-        # (unindent)
-        hs.append(h)
-    # (unindent)
-    feature_block = tf.stack(hs, axis=1)
+            h = tf.reshape(h, (-1, len(pairs), h.shape[-1]))
+        locs = tf.gather(loc_input, pairs, axis=2)  # (batch, 2, pairs, 2)
+        d = locs[:, :, :, 0] - locs[:, :, :, 1]
+        d = tf.norm(d, ord="euclidean", axis=1)
+        d = tf.expand_dims(d, axis=-1)
+        h = tf.keras.layers.concatenate([h, d])
+        return DENSE_0(h)
+
+    pair_index = np.array(list(combinations))
+    encode_mask = np.array([comb in combinations_encode
+                            for comb in combinations])
+    args.pair_index, args.encode_mask = pair_index, encode_mask  # (export)
+    hs = []
+    if np.any(encode_mask):
+        hs.append(encode_pairs(pair_index[encode_mask]))
+    if not np.all(encode_mask):  # cut gradient tape on some pairs
+        hs.append(tf.stop_gradient(encode_pairs(pair_index[~encode_mask])))
+    if len(hs) > 1:  # (back to the original pair order)
+        order = np.concatenate([np.flatnonzero(encode_mask),
+                                np.flatnonzero(~encode_mask)])
+        feature_block = tf.gather(tf.concat(hs, axis=1), np.argsort(order),
+                                  axis=1)
+    else:
+        feature_block = hs[0]
     print("\nfeature block:", feature_block.shape)
 
     # apply 2d dense layer
@@ -364,7 +567,12 @@ def load_network():
         inputs=[geno_input, loc_input],
         outputs=[output],
     )
-    model.compile(loss="mse", optimizer=opt)
+    model.compile(
+        loss="mse",
+        optimizer=opt,
+        jit_compile=args.jit_compile,
+        steps_per_execution=args.steps_per_execution,
+    )
     # model.summary()
     for v in model.trainable_variables:
         print(v.name)
@@ -375,12 +583,15 @@ def load_network():
     )
 
     # load weights
-    if args.predict is True:
+    if trained is True:
         if args.load_weights is None:
             weights = args.out + "/Train/disperseNN2_" + \
                 str(args.seed) + "_model.hdf5"
         else:
             weights = args.load_weights
+        if os.path.isfile(weights) is False:
+            print("no trained weights found:", weights)
+            exit()
         print("loading weights:", weights)
         model.load_weights(weights)
 
@@ -411,6 +622,79 @@ def load_network():
     return model, checkpointer, earlystop, reducelr
 
 
+# folder of the exported model to predict with, or None if there isn't one
+def export_path():
+    if args.load_weights is not None:
+        path = args.load_weights
+    else:
+        path = args.out + "/Train/disperseNN2_" + str(args.seed) + "_export"
+    if os.path.isdir(path):
+        return path
+    return None
+
+
+# save the best weights as a self-contained SavedModel, along with the pairs
+# of individuals used and the training params for normalizing targets
+def export_network(model, chief=True):
+    path = args.out + "/Train/disperseNN2_" + str(args.seed) + "_export"
+    if chief is False:  # (other workers take part in saving, then discard)
+        tmp = path + ".worker" + str(args.worker_index)
+        model.save(tmp, include_optimizer=False)
+        shutil.rmtree(tmp)
+        return
+    model.load_weights(args.out + "/Train/disperseNN2_"
+                       + str(args.seed) + "_model.hdf5")
+    if args.training_mean_sd is None:
+        training_params = np.load(args.out + "/Train/training_params.npy")
+    else:
+        training_params = np.load(args.training_mean_sd)
+    tmp = path + ".tmp" + str(os.getpid())
+    model.save(tmp, include_optimizer=False)
+    np.save(os.path.join(tmp, "training_params"), training_params)
+    np.save(os.path.join(tmp, "pairs"),
+            np.column_stack([args.pair_index, args.encode_mask]))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    print("exported model:", path)
+    return
+
+
+# path of the TFLite model with the given precision
+def lite_path(precision):
+    return (args.out + "/Train/disperseNN2_" + str(args.seed) + "_"
+            + precision + ".tflite")
+
+
+# load the exported model if there is one, otherwise rebuild the network
+# (or the TFLite model, if predicting with --lite)
+def load_trained_network():
+    configure_devices()
+    if args.lite is not None and args.quantize is False:
+        print("loading TFLite model:", lite_path(args.lite))
+        model = LiteModel(lite_path(args.lite), args.threads)
+    elif export_path() is None:
+        model, checkpointer, earlystop, reducelr = load_network(trained=True)
+    else:
+        print("loading exported model:", export_path())
+        model = tf.keras.models.load_model(export_path(), compile=False)
+        model.compile(jit_compile=args.jit_compile,
+                      steps_per_execution=args.steps_per_execution)
+    return model
+
+
+# n, num_snps, and mean and sd of the training targets
+def read_training_params():
+    if args.training_mean_sd is not None:
+        path = args.training_mean_sd
+    elif export_path() is not None:
+        path = os.path.join(export_path(), "training_params.npy")
+    else:
+        path = args.out + "/Train/training_params.npy"
+    n, num_snps, meanSig, sdSig = np.load(path)
+    return int(n), int(num_snps), meanSig, sdSig
+
+
 def make_generator_params_dict(
     targets,
     trees,
@@ -439,15 +723,125 @@ def make_generator_params_dict(
         "grid_coarseness": args.grid_coarseness,
         "sample_grid": args.sample_grid,
         "empirical_locs": empirical_locs,
+        "auto_mu": args.auto_mu,
+        "recap_cache": args.recap_cache,
+        "recap_cache_size": args.recap_cache_size,
     }
     return params
 
 
+# name of the k-th sample from tree i
+def example_name(i, k):
+    if args.num_samples == 1:
+        return str(i)
+    return str(i) + "_" + str(k)
+
+
+# process a single tree sequence (runs in a worker process)
+def preprocess_tree(task):
+    (i, split, seed, treefile, target_path, target,
+     meanSig, sdSig, locs, draws) = task
+    mus, examples, records = [], [], []
+    try:
+        if target is None:  # (no catalog)
+            with open(target_path) as infile:
+                target = float(infile.readline().strip())
+        target = (np.log(target) - meanSig) / sdSig
+        ts = None
+        for k in draws:  # repeated samples from the same ts
+            example = example_name(i, k)
+            draw_seed = seed if k == 0 else task_seed(args.seed, i, k)
+            if ts is None:  # load and recapitate once, for all draws
+                params = make_generator_params_dict(
+                    targets=None,
+                    trees=None,
+                    shuffle=None,
+                    genos=None,
+                    locs=None,
+                    empirical_locs=None,
+                )
+                training_generator = DataGenerator([None], **params)
+                ts, W, edge_width, alive_inds = \
+                    training_generator.load_ts(treefile, seed)
+            np.random.seed(draw_seed)
+            if locs is not None:
+                training_generator.empirical_locs = project_locs(
+                    locs, treefile, W
+                )
+            geno_mat, sample_locs = training_generator.sample_loaded_ts(
+                ts, W, edge_width, alive_inds, draw_seed
+            )
+            if training_generator.mu_used is not None:
+                mus.append((example, training_generator.mu_used))
+            if args.pack_genos is True:
+                geno_mat = pack_genos(geno_mat, args.phase)
+            if args.shard_size is not None:  # (parent writes the shards)
+                examples.append((example, geno_mat, sample_locs, target))
+                continue
+            paths = [
+                os.path.join(folder, str(args.seed), example + suffix)
+                for folder, suffix in [("Genos", ".genos.npy"),
+                                       ("Locs", ".locs.npy"),
+                                       ("Targets", ".target.npy")]
+            ]
+            save_atomic(os.path.join(args.out, split, paths[0]), geno_mat)
+            save_atomic(os.path.join(args.out, split, paths[1]), sample_locs)
+            save_atomic(os.path.join(args.out, split, paths[2]), target)
+            # (parent adds the example to the manifest once all are written)
+            records.append(
+                manifest_line(example, args.seed, paths, -1, geno_mat)
+            )
+    except (Exception, SystemExit) as e:  # report, but keep going
+        return i, split, treefile, mus, examples, records, repr(e)
+
+    return i, split, treefile, mus, examples, records, None
+
+
+# write a full shard, then add its examples to the split's manifest
+def flush_shard(shard_dir, shard_id, examples, manifest):
+    write_shard(shard_dir, shard_id, examples)
+    prefix = os.path.join("Shards", str(args.seed), str(shard_id))
+    paths = [prefix + ".genos.npy", prefix + ".locs.npy",
+             prefix + ".targets.npy"]
+    for offset, (example, geno_mat, sample_locs, target) in enumerate(
+        examples
+    ):
+        print(manifest_line(example, args.seed, paths, offset, geno_mat),
+              file=manifest, flush=True)
+    return
+
+
+# read the tree sequence catalog, building it first if needed
+def load_catalog(trees, target_paths):
+    if os.path.isfile(args.catalog) is False:
+        print("cataloging", len(trees), "tree sequences", flush=True)
+        tasks = list(zip(trees, target_paths))
+        if args.threads > 1:
+            pool = multiprocessing.get_context("fork").Pool(args.threads)
+            entries = pool.map(catalog_entry, tasks, chunksize=16)
+            pool.close()
+            pool.join()
+        else:
+            entries = list(map(catalog_entry, tasks))
+        write_catalog(args.catalog, entries)
+    catalog = read_catalog(args.catalog)
+    if catalog["tree"] != trees or catalog["target_path"] != target_paths:
+        print("catalog doesn't match --tree_list and --target_list;",
+              "delete it to rebuild")
+        exit()
+    return catalog
+
+
 def preprocess():
     # read lists
     trees = read_list(args.tree_list)
     target_paths = read_list(args.target_list)
     total_sims = len(trees)
+    if args.catalog is not None:
+        catalog = load_catalog(trees, target_paths)
+        targets = list(catalog["target"])
+    else:
+        targets = [None] * total_sims
 
     # separate training and test data
     train, test = train_test_split(np.arange(total_sims),
@@ -458,13 +852,16 @@ def preprocess():
         n, num_snps, meanSig, sdSig = np.load(
             args.out + "/Train/training_params.npy")
     else:
-        targets = []
+        train_targets = []
         for i in train:
-            with open(target_paths[i]) as infile:
-                arr = np.log(float(infile.readline().strip()))
-            targets.append(arr)
-        meanSig = np.mean(targets)
-        sdSig = np.std(targets)
+            if targets[i] is not None:
+                arr = np.log(targets[i])
+            else:
+                with open(target_paths[i]) as infile:
+                    arr = np.log(float(infile.readline().strip()))
+            train_targets.append(arr)
+        meanSig = np.mean(train_targets)
+        sdSig = np.std(train_targets)
         os.makedirs(args.out + "/Train", exist_ok=True)
         np.save(
             args.out + "/Train/training_params",
@@ -497,67 +894,196 @@ def preprocess():
                              str(args.seed)),
                 exist_ok=True)
 
-    # process
-    load_dl_modules()  # (to get data generator)
+    # empirical sampling locations (same table for every tree)
+    if args.empirical is not None:
+        locs = read_locs(args.empirical + ".locs")
+        if len(locs) != args.n:
+            print("length of locs file doesn't match n")
+            exit()
+    else:
+        locs = None
+
+    # examples already done, from the manifests
+    done, manifests = {}, {}
+    shard_dirs, shard_counts = {}, {}
+    for split in ["Train", "Test"]:
+        done[split] = set(
+            fields[0]
+            for fields in read_manifest(os.path.join(args.out, split))
+            if fields[1] == str(args.seed)
+        )
+        manifests[split] = open_manifest(os.path.join(args.out, split))
+        if args.shard_size is not None:
+            shard_dirs[split] = os.path.join(
+                args.out, split, "Shards", str(args.seed)
+            )
+            os.makedirs(shard_dirs[split], exist_ok=True)
+            shard_counts[split] = read_shard_index(shard_dirs[split])[1]
+
+    # organize one task per tree sequence
+    tasks = []
+    test = set(test)
     for i in range(total_sims):
         if i in test:
             split = "Test"
         else:
             split = "Train"
-        targetfile = os.path.join(
-            args.out, split, "Targets", str(args.seed), str(i) + ".target"
+        draws = [k for k in range(args.num_samples)
+                 if example_name(i, k) not in done[split]]
+        if len(draws) > 0:
+            seed = task_seed(args.seed, i)
+            tasks.append(
+                (i, split, seed, trees[i], target_paths[i], targets[i],
+                 meanSig, sdSig, locs, draws)
+            )
+
+    # process
+    load_dl_modules()  # (to get data generator)
+    if args.threads > 1:
+        pool = multiprocessing.get_context("fork").Pool(args.threads)
+        results = pool.imap_unordered(preprocess_tree, tasks)
+    else:
+        pool = None
+        results = map(preprocess_tree, tasks)
+    failed = []
+    shard_buffers = {"Train": [], "Test": []}
+    report_every = max(1, int(total_sims / 100))
+    mu_file = open(os.path.join(args.out, "mutation_rates_"
+                                + str(args.seed) + ".txt"), "a")
+    for counter, (i, split, treefile, mus, examples, records,
+                  error) in enumerate(results):
+        for example, mu in mus:  # (record the mutation rates that were used)
+            print(example, mu, sep="\t", file=mu_file, flush=True)
+        for record in records:
+            print(record, file=manifests[split], flush=True)
+        for example in examples:  # (write out a shard once it fills up)
+            shard_buffers[split].append(example)
+            if len(shard_buffers[split]) == args.shard_size:
+                flush_shard(shard_dirs[split], shard_counts[split],
+                            shard_buffers[split], manifests[split])
+                shard_counts[split] += 1
+                shard_buffers[split] = []
+        if error is not None:
+            print("\tfailed on tree", i, treefile, error, flush=True)
+            failed.append((i, treefile, error))
+        if (counter + 1) % report_every == 0 or counter + 1 == len(tasks):
+            print("processed", counter + 1, "of", len(tasks),
+                  "tree sequences,", len(failed), "failed", flush=True)
+    for split in shard_buffers:  # (last, partial shards)
+        if len(shard_buffers[split]) > 0:
+            flush_shard(shard_dirs[split], shard_counts[split],
+                        shard_buffers[split], manifests[split])
+    for split in manifests:
+        manifests[split].close()
+    mu_file.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # record failures
+    if len(failed) > 0:
+        with open(os.path.join(args.out, "preprocess_failures_"
+                               + str(args.seed) + ".txt"), "w") as out_f:
+            for i, treefile, error in sorted(failed):
+                print(i, treefile, error, sep="\t", file=out_f)
+
+    return
+
+
+# one memory-mapped array per input for a split; packed on first use, and
+# again whenever the split's examples change
+def memmap_split(path, targets, genos, locs):
+    pack_dir = os.path.join(path, "Packed")
+    fingerprint = split_fingerprint(path, targets, genos, locs)
+    packed = read_packed(pack_dir)
+    if packed is None or packed[3] != fingerprint:
+        print("packing", path, "into memory-mappable arrays", flush=True)
+        pack_split(pack_dir, targets, genos, locs, fingerprint)
+        packed = read_packed(pack_dir)
+    return packed[:3]
+
+
+# targets and tree paths for training straight from the tree sequences
+def on_the_fly_inputs():
+    trees = read_list(args.tree_list)
+    target_paths = read_list(args.target_list)
+    if args.catalog is not None:
+        catalog = load_catalog(trees, target_paths)
+        targets = np.log(catalog["target"])
+    else:
+        targets = []
+        for path in target_paths:
+            with open(path) as infile:
+                targets.append(np.log(float(infile.readline().strip())))
+        targets = np.array(targets)
+    if os.path.isfile(args.out + "/Train/training_params.npy"):
+        n, num_snps, meanSig, sdSig = np.load(
+            args.out + "/Train/training_params.npy")
+    else:
+        meanSig = np.mean(targets)
+        sdSig = np.std(targets)
+        os.makedirs(args.out + "/Train", exist_ok=True)
+        np.save(
+            args.out + "/Train/training_params",
+            [args.n, args.num_snps, meanSig, sdSig]
         )
-        genofile = os.path.join(
-            args.out, split, "Genos", str(args.seed), str(i) + ".genos"
+    targets = (targets - meanSig) / sdSig
+
+    return targets, trees
+
+
+# tf.data input for multi-worker training: each worker loads its own shard
+# of the examples, in batches of the per-worker share of --batch_size
+def worker_dataset(ids, params):
+    def dataset_fn(input_context):
+        shard_params = dict(params)
+        shard_params["batch_size"] = input_context.get_per_replica_batch_size(
+            args.batch_size
         )
-        locfile = os.path.join(
-            args.out, split, "Locs", str(args.seed), str(i) + ".locs"
+        generator = DataGenerator(
+            ids[input_context.input_pipeline_id::
+                input_context.num_input_pipelines],
+            **shard_params
         )
-        if (
-            os.path.isfile(genofile + ".npy") is False
-            or os.path.isfile(locfile + ".npy") is False
-        ):
-            if args.empirical is not None:
-                locs = read_locs(args.empirical + ".locs")
-                if len(locs) != args.n:
-                    print("length of locs file doesn't match n")
-                    exit()
-                locs = project_locs(locs, trees[i])
-            else:
-                locs = None
-            params = make_generator_params_dict(
-                targets=None,
-                trees=None,
-                shuffle=None,
-                genos=None,
-                locs=None,
-                empirical_locs=locs,
-            )
-            training_generator = DataGenerator([None], **params)
-            geno_mat, locs = training_generator.sample_ts(trees[i], args.seed)
-            np.save(genofile, geno_mat)
-            np.save(locfile, locs)
-        if (
-            os.path.isfile(genofile + ".npy") is True
-            and os.path.isfile(locfile + ".npy") is True
-        ):  # (only add target if inputs successful)
-            if os.path.isfile(targetfile + ".npy") is False:
-                with open(target_paths[i]) as infile:
-                    target = np.log(float(infile.readline().strip()))
-                target = (target - meanSig) / sdSig
-                np.save(targetfile, target)
+        return generator.dataset(seed=args.seed).repeat()
+
+    return tf.keras.utils.experimental.DatasetCreator(dataset_fn)
 
-    return
+
+# split example ids into train and val sets, keeping repeated samples from
+# the same tree sequence together
+def split_train_val(total_sims):
+    sim_ids = np.arange(0, total_sims)
+    if args.on_the_fly is True:
+        tree_ids = sim_ids
+    else:
+        tree_ids = tree_ids_from_preprocessed(args.out + "/Train/")
+    if len(np.unique(tree_ids)) == total_sims:
+        return train_test_split(sim_ids, test_size=args.validation_split)
+    return next(GroupShuffleSplit(
+        n_splits=1, test_size=args.validation_split
+    ).split(sim_ids, groups=tree_ids))
 
 
 def train():
     # read targets
     print("reading input paths", flush=True)
-    targets, genos, locs = dict_from_preprocessed(args.out + "/Train/")
-    total_sims = len(targets)
+    if args.on_the_fly is True:
+        targets, trees = on_the_fly_inputs()
+        genos = locs = None
+        total_sims = len(targets)
+    else:
+        targets, genos, locs = dict_from_preprocessed(args.out + "/Train/")
+        trees = None
+        total_sims = len(targets)
+        if args.memmap is True:
+            targets, genos, locs = memmap_split(args.out + "/Train/",
+                                                targets, genos, locs)
 
     # grab n and num_snps from preprocessed dir
-    if args.training_mean_sd is None:
+    if args.on_the_fly is True:
+        pass  # (given on the command line)
+    elif args.training_mean_sd is None:
         args.n, args.num_snps, meanSig, sdSig = np.load(
             args.out + "/Train/training_params.npy"
         )
@@ -566,12 +1092,11 @@ def train():
     args.n, args.num_snps = int(args.n), int(args.num_snps)
 
     # split into val,train sets
-    sim_ids = np.arange(0, total_sims)
-    train, val = train_test_split(sim_ids, test_size=args.validation_split)
+    train, val = split_train_val(total_sims)
     if (
-        len(val) * args.num_samples % args.batch_size != 0
-        or len(train) * args.num_samples % args.batch_size != 0
-    ):
+        len(val) % args.batch_size != 0
+        or len(train) % args.batch_size != 0
+    ):  # (repeated samples are already separate files)
         print(
             "\n\ntrain and val sets each need to be divisible by batch_size; \
             otherwise some batches will have missing data\n\n"
@@ -586,18 +1111,47 @@ def train():
     # initialize generators
     params = make_generator_params_dict(
         targets=targets,
-        trees=None,
+        trees=trees,
         shuffle=True,
         genos=genos,
         locs=locs,
         empirical_locs=None,
     )
+    if args.on_the_fly is True and args.empirical is not None:
+        params["empirical_latlon"] = read_locs(args.empirical + ".locs")
     load_dl_modules()
-    training_generator = DataGenerator(partition["train"], **params)
+    training_generator = DataGenerator(partition["train"],
+                                       resample=args.on_the_fly,
+                                       **params)
     validation_generator = DataGenerator(partition["validation"], **params)
 
     # train
-    model, checkpointer, earlystop, reducelr = load_network()
+    configure_devices()
+    strategy = load_strategy()
+    steps = {}
+    if strategy is None:
+        model, checkpointer, earlystop, reducelr = load_network(args.predict)
+    else:  # (a replica of the model on each worker)
+        with strategy.scope():
+            model, checkpointer, earlystop, reducelr = load_network(
+                args.predict
+            )
+        training_generator = worker_dataset(partition["train"], params)
+        validation_generator = worker_dataset(partition["validation"], params)
+        steps["steps_per_epoch"] = len(train) // args.batch_size
+        steps["validation_steps"] = len(val) // args.batch_size
+    if args.tf_data is True and strategy is None:  # (parallel loading)
+        if args.cache_dataset is not None and args.cache_dataset != "memory":
+            training_cache = args.cache_dataset + "_train"
+            validation_cache = args.cache_dataset + "_val"
+        else:
+            training_cache = validation_cache = args.cache_dataset
+        training_generator = training_generator.dataset(
+            seed=args.seed, cache=training_cache
+        )
+        validation_generator = validation_generator.dataset(
+            seed=args.seed, cache=validation_cache
+        )
     print("training!")
     model.fit(
         x=training_generator,
@@ -606,27 +1160,93 @@ def train():
         verbose=args.keras_verbose,
         validation_data=validation_generator,
         callbacks=[checkpointer, earlystop, reducelr],
+        workers=args.sim_workers,  # (ignored for tf.data input)
+        use_multiprocessing=args.sim_workers > 1,
+        max_queue_size=args.queue_depth,
+        **steps,
     )  # multi-thread via tf.config.threading.set_intra_op_parallelism_threads
+    export_network(model, chief=strategy is None
+                   or strategy.cluster_resolver.task_id == 0)
+
+    return
+
+
+# convert the trained model to TFLite, then compare the two on the test set
+def quantize():
+    args.n, args.num_snps, meanSig, sdSig = read_training_params()
+    targets, genos, locs = dict_from_preprocessed(args.out + "/Test/")
+    if args.num_pred is None:
+        args.num_pred = len(targets)
+    simids = np.arange(args.num_pred)
+    load_dl_modules()
+    model = load_trained_network()
+    convert_lite(model, args.lite, lite_path(args.lite))
+    lite_model = LiteModel(lite_path(args.lite), args.threads)
+
+    # predict on the same batches with both models
+    params = make_generator_params_dict(
+        targets=targets,
+        trees=None,
+        shuffle=False,
+        genos=genos,
+        locs=locs,
+        empirical_locs=None,
+    )
+    generator = DataGenerator(simids, **params)
+    batches = [generator[b] for b in range(len(generator))]
+    times, preds = {}, {}
+    for name, m in [("full", model), ("lite", lite_model)]:
+        m.predict_on_batch(batches[0][0])  # (warm up)
+        start = time.perf_counter()
+        preds[name] = np.concatenate(
+            [np.asarray(m.predict_on_batch(X)) for X, y in batches]
+        )[:, 0]
+        times[name] = time.perf_counter() - start
+    truevals = np.concatenate([y for X, y in batches])
+
+    # report, in the original units
+    full = np.exp(preds["full"] * sdSig + meanSig)
+    lite = np.exp(preds["lite"] * sdSig + meanSig)
+    truevals = np.exp(truevals * sdSig + meanSig)
+    report = [
+        ("precision", args.lite),
+        ("test examples", len(truevals)),
+        ("size (MB), full", np.round(model.count_params() * 4 / 1e6, 3)),
+        ("size (MB), lite",
+         np.round(os.path.getsize(lite_path(args.lite)) / 1e6, 3)),
+        ("RMSLE vs truth, full",
+         np.sqrt(np.mean((np.log(full) - np.log(truevals)) ** 2))),
+        ("RMSLE vs truth, lite",
+         np.sqrt(np.mean((np.log(lite) - np.log(truevals)) ** 2))),
+        ("max relative difference, lite vs full",
+         np.max(np.abs(lite - full) / full)),
+        ("mean relative difference, lite vs full",
+         np.mean(np.abs(lite - full) / full)),
+        ("examples per second, full", len(truevals) / times["full"]),
+        ("examples per second, lite", len(truevals) / times["lite"]),
+    ]
+    reportfile = lite_path(args.lite).replace(".tflite", "_report.txt")
+    with open(reportfile, "w") as out_f:
+        for name, value in report:
+            print(name, value, sep="\t", file=out_f)
+            print(name + ":", value)
+    print("TFLite model:", lite_path(args.lite))
 
     return
 
 
 def predict():
     # grab mean and sd from training distribution
-    if args.training_mean_sd is None:
-        args.n, args.num_snps, meanSig, sdSig = np.load(
-            args.out + "/Train/training_params.npy"
-        )
-    else:
-        args.n, args.num_snps, meanSid, sdSig = np.load(args.training_mean_sd)
-    args.n, args.num_snps = int(args.n), int(args.num_snps)
+    args.n, args.num_snps, meanSig, sdSig = read_training_params()
 
     # load inputs
     targets, genos, locs = dict_from_preprocessed(args.out + "/Test/")
     total_sims = len(targets)
+    if args.memmap is True:
+        targets, genos, locs = memmap_split(args.out + "/Test/",
+                                            targets, genos, locs)
 
-    # organize "partition" to hand to data generator
-    partition = {}
+    # choose the datasets to predict on
     if args.num_pred is None:
         args.num_pred = int(total_sims)
     simids = np.random.choice(np.arange(total_sims),
@@ -650,41 +1270,55 @@ def predict():
         print("pred output exists; overwriting...")
         os.remove(outfile)
     load_dl_modules()
-    model, checkpointer, earlystop, reducelr = load_network()
-    for b in range(
-        int(np.ceil(args.num_pred / args.batch_size))
-    ):  # loop to alleviate memory
-        simids_batch = simids[b * args.batch_size:(b + 1) * args.batch_size]
-        partition["prediction"] = np.array(simids_batch)
-        generator = DataGenerator(partition["prediction"], **params)
-        predictions = model.predict(generator)
-
-        # unpack predictions
-        with open(
-            args.out + "/Test/predictions_" + str(args.seed) + ".txt", "a"
-        ) as out_f:
-            for i in range(len(predictions)):
-                trueval = np.load(targets[simids_batch[i]])
-                trueval = (trueval * sdSig) + meanSig
-                trueval = np.exp(trueval)
-                prediction = predictions[i][0]
-                prediction = (prediction * sdSig) + meanSig
-                prediction = np.exp(prediction)
-                outline = "\t".join(map(str, [trueval, prediction]))
-                print(outline, file=out_f)
+    model = load_trained_network()
+    generator = DataGenerator(list(simids), **params)
+    dataset = generator.dataset(seed=args.seed, drop_remainder=False)
+    lines = queue.Queue(maxsize=100)
+    writer = start_writer(outfile, lines)
+
+    def write_batch(predictions, truevals):  # (un-normalize both at once)
+        values = np.column_stack([truevals, predictions[:, 0]])
+        values = np.exp((values * sdSig) + meanSig)
+        lines.put("".join("\t".join(map(str, row)) + "\n" for row in values))
+
+    stream_predictions(model, dataset, write_batch)
+    lines.put(None)
+    writer.join()
+
+    return
+
 
+# predict on every batch of a dataset of ((genos, locs), targets), passing
+# the predictions and targets of each batch to on_batch as they come out
+def stream_predictions(model, dataset, on_batch):
+    if isinstance(model, LiteModel):
+        for (X1, X2), y in dataset.as_numpy_iterator():
+            on_batch(model.predict_on_batch([X1, X2]), y)
+        return
+    geno_input = tf.keras.layers.Input(shape=(args.num_snps, args.n))
+    loc_input = tf.keras.layers.Input(shape=(2, args.n))
+    target_input = tf.keras.layers.Input(shape=(), dtype="float64")
+    tagged = tf.keras.Model(  # (targets pass straight through)
+        inputs=[geno_input, loc_input, target_input],
+        outputs=[model([geno_input, loc_input]), target_input],
+    )
+    tagged.compile(jit_compile=args.jit_compile,
+                   steps_per_execution=args.steps_per_execution)
+    tagged.predict(
+        dataset.map(lambda X, y: ((X[0], X[1], y),)),
+        verbose=args.keras_verbose,
+        callbacks=[tf.keras.callbacks.LambdaCallback(
+            on_predict_batch_end=lambda batch, logs: on_batch(
+                *logs["outputs"]
+            )
+        )],
+    )
     return
 
 
 def empirical():
     # grab mean and sd from training distribution
-    if args.training_mean_sd is None:
-        args.n, args.num_snps, meanSig, sdSig = np.load(
-            args.out + "/Train/training_params.npy"
-        )
-    else:
-        args.n, args.num_snps, meanSid, sdSig = np.load(args.training_mean_sd)
-    args.n, args.num_snps = int(args.n), int(args.num_snps)
+    args.n, args.num_snps, meanSig, sdSig = read_training_params()
 
     # project locs
     locs = read_locs(args.empirical + ".locs")
@@ -711,29 +1345,147 @@ def empirical():
 
     # load model
     load_dl_modules()
-    model, checkpointer, earlystop, reducelr = load_network()
+    model = load_trained_network()
 
-    # convert vcf to geno matrix
-    for i in range(args.num_reps):
-        test_genos = vcf2genos(
-            args.empirical + ".vcf", args.n, args.num_snps, args.phase
-        )
-        # (doesn't work if sample locations are repeated)
-        # ibd(test_genos, locs, args.phase, args.num_snps)
-        test_genos = np.reshape(
-            test_genos, (1, test_genos.shape[0], test_genos.shape[1])
-        )
-        test_locs = np.reshape(locs, (1, locs.shape[1], locs.shape[0]))
-        prediction = model.predict([test_genos, test_locs])
-
-        # unpack_prediction
-        with open(args.out + "/empirical_" + str(args.seed) + ".txt", "a") \
-             as out_f:
-            prediction = prediction[0][0]
-            prediction = (prediction * sdSig) + meanSig
-            prediction = np.exp(prediction)
-            prediction = np.round(prediction, 10)
-            print(args.empirical, "rep" + str(i), prediction, file=out_f)
+    # convert vcf to geno matrix, once; a single draw is reservoir sampled
+    # while streaming the vcf, so large vcfs aren't held in memory
+    vcf_path = args.empirical + ".vcf"
+    if not os.path.exists(vcf_path) and os.path.exists(vcf_path + ".gz"):
+        vcf_path += ".gz"
+    if args.num_reps == 1:
+        geno_mat = vcf2genos(vcf_path, args.n, args.num_snps, args.phase)
+    else:
+        geno_mat = read_vcf(vcf_path, args.n, args.phase)
+    # (doesn't work if sample locations are repeated)
+    # ibd(sample_snps(geno_mat, args.num_snps), locs, args.phase,
+    #     args.num_snps)
+    test_locs = np.reshape(locs, (1, locs.shape[1], locs.shape[0]))
+
+    # predict on batches of replicates, each a new random draw of snps
+    with open(args.out + "/empirical_" + str(args.seed) + ".txt", "a") \
+         as out_f:
+        for start in range(0, args.num_reps, args.batch_size):
+            reps = range(start, min(start + args.batch_size, args.num_reps))
+            test_genos = np.stack(
+                [geno_mat if args.num_reps == 1
+                 else sample_snps(geno_mat, args.num_snps) for i in reps]
+            )
+            predictions = model.predict_on_batch(
+                [test_genos, np.repeat(test_locs, len(reps), axis=0)]
+            )
+
+            # unpack predictions
+            predictions = np.asarray(predictions)[:, 0].astype(float)
+            predictions = (predictions * sdSig) + meanSig
+            predictions = np.exp(predictions)
+            predictions = np.round(predictions, 10)
+            for i, prediction in zip(reps, predictions):
+                print(args.empirical, "rep" + str(i), prediction,
+                      file=out_f)
+
+    return
+
+
+# time a few synthetic training steps with one setting (runs in a child
+# process, so that peak memory is measured for this setting alone)
+def autotune_trial(batch_size, pairs_encode, conn):
+    args.batch_size, args.pairs_encode = batch_size, pairs_encode
+    with contextlib.redirect_stdout(io.StringIO()):  # (layer listing)
+        load_dl_modules()
+        configure_devices()
+        model = load_network()[0]
+    X = [np.random.randint(0, 3, (batch_size, args.num_snps, args.n)),
+         np.random.uniform(size=(batch_size, 2, args.n))]
+    y = np.random.normal(size=batch_size)
+    model.train_on_batch(X, y)  # (warm up)
+    num_steps = 5
+    start = time.perf_counter()
+    for step in range(num_steps):
+        model.train_on_batch(X, y)
+    rate = num_steps * batch_size / (time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6  # (GB)
+    conn.send((rate, peak))
+    return
+
+
+# find the fastest batch size and pairs_encode that fit in the RAM budget
+def autotune():
+    if args.n is None or args.num_snps is None:
+        args.n, args.num_snps, meanSig, sdSig = read_training_params()
+    if args.pairs is None:
+        args.pairs = int((args.n * (args.n - 1)) / 2)
+    batch_sizes = [5, 10, 20, 50, 100]
+    if args.train is True:  # (only batch sizes that divide the split)
+        if args.on_the_fly is True:
+            total_sims = len(read_list(args.tree_list))
+        else:
+            total_sims = len(dict_from_preprocessed(args.out + "/Train/")[0])
+        state = np.random.get_state()  # (train() makes the same split)
+        train, val = split_train_val(total_sims)
+        np.random.set_state(state)
+        batch_sizes = [b for b in batch_sizes
+                       if len(train) % b == 0 and len(val) % b == 0]
+        if len(batch_sizes) == 0:
+            print("none of the candidate batch sizes divide the train",
+                  "and val sets evenly")
+            exit()
+    if args.pairs_encode is None:
+        pairs_encodes = sorted(set(
+            max(1, args.pairs // d) for d in [1, 2, 4, 10]
+        ), reverse=True)
+    else:
+        pairs_encodes = [args.pairs_encode]
+
+    # one child process per setting; more memory with more batches or pairs
+    ctx = multiprocessing.get_context("fork")
+    results, too_big = [], []
+    print("batch_size", "pairs_encode", "examples/s", "peak GB",
+          sep="\t", flush=True)
+    for batch_size in batch_sizes:
+        for pairs_encode in pairs_encodes:
+            if any(batch_size >= b and pairs_encode >= p for b, p in too_big):
+                continue  # (can only need more memory than a failed one)
+            parent_conn, child_conn = ctx.Pipe()
+            trial = ctx.Process(target=autotune_trial,
+                                args=(batch_size, pairs_encode, child_conn))
+            trial.start()
+            trial.join()
+            if parent_conn.poll():
+                rate, peak = np.round(parent_conn.recv(), 2)
+            else:  # (crashed, e.g. out of memory)
+                rate, peak = None, None
+            if peak is None or peak > args.autotune:
+                too_big.append((batch_size, pairs_encode))
+            else:
+                results.append((rate, batch_size, pairs_encode, peak))
+            print(batch_size, pairs_encode, rate, peak, sep="\t", flush=True)
+    if len(results) == 0:
+        print("no setting fits in", args.autotune, "GB")
+        exit()
+
+    # report, and apply: the most pairs_encode that fits (fewer pairs in the
+    # gradient is a memory lever, not a free speedup), at its fastest batch
+    rate, batch_size, pairs_encode, peak = max(
+        results, key=lambda r: (r[2], r[0])
+    )
+    print("chosen within", args.autotune, "GB: --batch_size", batch_size,
+          "--pairs", args.pairs, "--pairs_encode", pairs_encode,
+          "(" + str(round(rate, 1)), "examples/s,",
+          round(peak, 2), "GB)")
+    fastest = max(results)
+    if fastest[2] < pairs_encode:
+        print("(--pairs_encode", fastest[2], "would be faster,",
+              round(fastest[0], 1), "examples/s, but encodes fewer pairs",
+              "per gradient step)")
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+        with open(os.path.join(args.out, "autotune_" + str(args.seed)
+                               + ".txt"), "w") as out_f:
+            print("batch_size", "pairs", "pairs_encode", "examples/s",
+                  "peak GB", sep="\t", file=out_f)
+            for r, b, p, m in sorted(results, reverse=True):
+                print(b, args.pairs, p, r, m, sep="\t", file=out_f)
+    args.batch_size, args.pairs_encode = batch_size, pairs_encode
 
     return
 
@@ -770,6 +1522,11 @@ def run():
         print("starting pre-processing pipeline")
         preprocess()
 
+    # choose batch size and pairs_encode
+    if args.autotune is not None:
+        print("autotuning batch size and pairs_encode")
+        autotune()
+
     # train
     if args.train is True:
         print("starting training pipeline")
@@ -779,6 +1536,11 @@ def run():
     if args.plot_history:
         plot_history()
 
+    # reduced-precision model
+    if args.quantize is True:
+        print("converting to a reduced-precision model")
+        quantize()
+
     # predict
     if args.predict is True:
         print("starting prediction pipeline")
@@ -0,0 +1,51 @@
+# reduced-precision (TFLite) models for CPU inference
+
+import numpy as np
+import tensorflow as tf
+import os
+
+
+# convert a trained keras model to TFLite, with float16 or int8 weights
+# (int8 is dynamic-range quantization: activations stay in float)
+def convert_lite(model, precision, path):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    lite = converter.convert()
+    tmp = path + ".tmp" + str(os.getpid())
+    with open(tmp, "wb") as outfile:
+        outfile.write(lite)
+    os.replace(tmp, path)
+    return
+
+
+class LiteModel:
+    "Keras-like predict_on_batch() on a TFLite model"
+
+    def __init__(self, path, threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path,
+                                               num_threads=threads)
+        self.interpreter.allocate_tensors()
+        inputs = self.interpreter.get_input_details()
+        # (the locations input is the one with 2 rows)
+        if inputs[0]["shape"][1] == 2:
+            inputs = inputs[::-1]
+        self.geno_index = inputs[0]["index"]
+        self.loc_index = inputs[1]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict_on_batch(self, x):
+        "Predict on a single batch, [genos, locs]"
+        genos = np.asarray(x[0], dtype=np.float32)
+        locs = np.asarray(x[1], dtype=np.float32)
+        if len(genos) != self.batch_size:  # (resize the inputs to the batch)
+            self.interpreter.resize_tensor_input(self.geno_index, genos.shape)
+            self.interpreter.resize_tensor_input(self.loc_index, locs.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(genos)
+        self.interpreter.set_tensor(self.geno_index, genos)
+        self.interpreter.set_tensor(self.loc_index, locs)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
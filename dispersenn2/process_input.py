@@ -2,6 +2,7 @@
 
 import numpy as np
 import sys
+import gzip
 from geopy import distance
 import random
 import utm
@@ -10,7 +11,7 @@ from dispersenn2.read_input import parse_provenance
 
 
 # project sample locations
-def project_locs(locs, fp=None):
+def project_locs(locs, fp=None, W=None):
     # projection (plus some code for calculating error)
     locs = np.array(locs)
     locs = np.array(utm.from_latlon(locs[:, 0], locs[:, 1])[0:2]) / 1000
@@ -31,9 +32,10 @@ def project_locs(locs, fp=None):
     locs[:, 1] = locs[:, 1] - min_long
 
     # reposition sample locations to random area within the map
-    if fp:
+    if W is None and fp:  # (map width from the catalog, if there is one)
         ts = tskit.load(fp)
         W = parse_provenance(ts, "W")
+    if W is not None:
         left_edge = np.random.uniform(low=0, high=W - long_range)
         bottom_edge = np.random.uniform(low=0, high=W - lat_range)
         locs[:, 0] += bottom_edge
@@ -42,6 +44,33 @@ def project_locs(locs, fp=None):
     return locs
 
 
+# catalog entry for one tree sequence: target, map width, sigma, number of
+# individuals and SLiM generation (nan if the provenance lacks a value)
+def catalog_entry(task):
+    treefile, target_path = task
+    with open(target_path) as infile:
+        target = float(infile.readline().strip())
+    ts = tskit.load(treefile)
+    entry = [treefile, target_path, target]
+    for param in ["W", "sigma"]:
+        try:
+            entry.append(parse_provenance(ts, param))
+        except ValueError:  # (not in the provenance)
+            entry.append(np.nan)
+    slim = ts.metadata.get("SLiM", {}) if isinstance(ts.metadata, dict) \
+        else {}
+    entry.append(ts.num_individuals)
+    entry.append(slim.get("tick", slim.get("generation", np.nan)))
+    return entry
+
+
+# per-tree (and per-draw) seed, so results don't depend on processing order
+def task_seed(baseseed, *keys):
+    if baseseed is None:
+        return None
+    return int(np.random.SeedSequence([baseseed, *keys]).generate_state(1)[0])
+
+
 # pad locations with zeros
 def pad_locs(locs, n):
     padded = np.zeros((2, n))
@@ -50,48 +79,150 @@ def pad_locs(locs, n):
     return padded
 
 
+# pack genotypes along the last axis: 1 bit per haplotype call (phase 2),
+# or 2 bits per 0/1/2 dosage (phase 1)
+def pack_genos(genos, phase):
+    genos = np.asarray(genos)
+    max_geno = 3 if phase == 1 else 1
+    if genos.min() < 0 or genos.max() > max_geno:  # (e.g. multi-allelic)
+        raise ValueError("genotypes outside 0-" + str(max_geno)
+                         + " can't be bit-packed")
+    genos = genos.astype(np.uint8)
+    if phase == 1:
+        genos = np.stack([genos >> 1, genos & 1], axis=-1).reshape(
+            genos.shape[:-1] + (-1,)
+        )
+    return np.packbits(genos, axis=-1)
+
+
+# unpack genotypes from pack_genos(); width is the unpacked last dimension
+def unpack_genos(packed, phase, width):
+    bits_per_geno = 2 if phase == 1 else 1
+    genos = np.unpackbits(packed, axis=-1, count=width * bits_per_geno)
+    if phase == 1:
+        genos = (genos[..., 0::2] << 1) | genos[..., 1::2]
+    return genos.astype(np.int8)
+
+
 # pre-processing rules:
 #     1 biallelic change the alelles to 0 and 1 before inputting.
 #     2. no missing data: filter or impute.
 #     3. ideally no sex chromosomes, and only look at one sex at a time.
+# (reservoir sampling: each site gets a random key, and the num_snps sites
+# with the smallest keys are kept, so memory stays at num_snps x n)
 def vcf2genos(vcf_path, n, num_snps, phase):
-    geno_mat = []
-    vcf = open(vcf_path, "r")
-    for line in vcf:
-        if line[0:2] == "##":
-            pass
-        elif line[0] == "#":
-            header = line.strip().split("\t")
-            if n is None:  # option for getting sample size from vcf
-                n = len(header) - 9
+    reservoir, keys, num_sites = None, np.empty(0), 0
+    for num_samples, lines in vcf_chunks(vcf_path):
+        if n is None:  # option for getting sample size from vcf
+            n = num_samples
+        chunk_keys = np.random.random(len(lines))
+        num_sites += len(lines)
+        if len(keys) == num_snps:  # (only parse sites that would get in)
+            keep = np.flatnonzero(chunk_keys < keys.max())
+            lines = [lines[i] for i in keep]
+            chunk_keys = chunk_keys[keep]
+        if len(lines) == 0:
+            continue
+        genos = parse_genos(lines, n, phase)
+        if reservoir is None:
+            reservoir = genos
         else:
-            newline = line.strip().split("\t")
-            genos = []
-            for field in range(9, len(newline)):
-                geno = newline[field].split(":")[0].split("/")
-                geno = [int(geno[0]), int(geno[1])]
-                if phase == 1:
-                    genos.append(sum(geno))
-                elif phase == 2:
-                    genos.append(geno[0])
-                    genos.append(geno[1])
-                else:
-                    print("problem")
-                    exit()
-            for i in range((n * phase) - len(genos)):  # pad with 0s
-                genos.append(0)
-            geno_mat.append(genos)
+            reservoir = np.concatenate([reservoir, genos])
+        keys = np.concatenate([keys, chunk_keys])
+        if len(keys) > num_snps:
+            smallest = np.argpartition(keys, num_snps - 1)[:num_snps]
+            reservoir, keys = reservoir[smallest], keys[smallest]
 
     # check if enough snps
-    if len(geno_mat) < num_snps:
+    if num_sites < num_snps:
         print("not enough snps")
         exit()
-    if len(geno_mat[0]) < (n * phase):
-        print("not enough samples")
+
+    return reservoir[np.argsort(keys)]  # (in random order)
+
+
+# read every site of a vcf into a genotype matrix (sites x n*phase)
+def read_vcf(vcf_path, n, phase):
+    geno_mat = []
+    for num_samples, lines in vcf_chunks(vcf_path):
+        if n is None:  # option for getting sample size from vcf
+            n = num_samples
+        geno_mat.append(parse_genos(lines, n, phase))
+    if len(geno_mat) == 0:
+        return np.zeros((0, n * phase), dtype=np.int8)
+    return np.concatenate(geno_mat)
+
+
+# read the data lines of a plain, gzipped or bgzipped vcf in chunks of
+# about chunk_bytes, each with the number of samples in the header
+def vcf_chunks(vcf_path, chunk_bytes=2**24):
+    with open(vcf_path, "rb") as infile:
+        gzipped = infile.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    num_samples = None
+    with opener(vcf_path, "rt") as vcf:
+        while True:
+            lines = vcf.readlines(chunk_bytes)
+            if len(lines) == 0:
+                break
+            if num_samples is None or lines[0][0] == "#":
+                for line in lines:
+                    if line[0:6] == "#CHROM":
+                        num_samples = len(line.strip().split("\t")) - 9
+                lines = [line for line in lines if line[0] != "#"]
+            if len(lines) > 0:
+                yield num_samples, lines
+
+
+# genotypes from a chunk of vcf lines, as an int8 matrix (sites x n*phase)
+def parse_genos(lines, n, phase):
+    samples = [line.rstrip("\n").split("\t", 9)[9] for line in lines]
+    joined = np.frombuffer(("\t".join(samples) + "\t").encode(), np.uint8)
+    num_samples = samples[0].count("\t") + 1
+    alleles = None
+    ends = np.flatnonzero(joined == ord("\t"))  # (tab after each field)
+    line_ends = np.cumsum([len(sample) + 1 for sample in samples]) - 1
+    if (
+        len(ends) == len(lines) * num_samples
+        and np.array_equal(ends[num_samples - 1::num_samples], line_ends)
+    ):  # (vectorized: "a/b" GT first, same number of samples on every line)
+        starts = np.concatenate([[0], ends[:-1] + 1])
+        if np.all(ends - starts >= 3):
+            after = joined[starts + 3]  # (":" before other subfields, or tab)
+            separator = joined[starts + 1]
+            if (
+                np.all((after == ord(":")) | (after == ord("\t")))
+                and np.all((separator == ord("/")) | (separator == ord("|")))
+            ):
+                alleles = np.stack(
+                    [joined[starts], joined[starts + 2]], axis=-1
+                ).reshape(len(lines), num_samples, 2) - ord("0")
+                if alleles.max() > 9:  # (e.g. missing genotypes)
+                    alleles = None
+    if alleles is None:  # (multi-digit alleles, or ragged lines)
+        alleles = np.array(
+            [[field.split(":")[0].replace("|", "/").split("/")
+              for field in sample.split("\t")] for sample in samples],
+            dtype=int,
+        )
+    if phase == 1:
+        genos = alleles.sum(axis=2)
+    elif phase == 2:
+        genos = alleles.reshape(len(lines), -1)
+    else:
+        print("problem")
         exit()
+    if genos.shape[1] < n * phase:  # pad with 0s
+        genos = np.pad(genos, ((0, 0), (0, n * phase - genos.shape[1])))
+
+    return genos.astype(np.int8)
 
-    # sample snps
-    geno_mat = np.array(geno_mat)
+
+# draw a random subset of snps from a genotype matrix
+def sample_snps(geno_mat, num_snps):
+    if geno_mat.shape[0] < num_snps:
+        print("not enough snps")
+        exit()
     return geno_mat[np.random.choice(geno_mat.shape[0],
                                      num_snps,
                                      replace=False), :]
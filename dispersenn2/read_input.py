@@ -2,6 +2,7 @@
 
 import numpy as np
 import os
+import zlib
 
 
 # reads a list of filepaths, stores in list
@@ -109,13 +110,88 @@ def parse_provenance(ts, param):
     prov = str(ts.provenance(0)).split()
     for i in range(len(prov)):
         if param + "=" in prov[i]:
-            val = float(prov[i].split("=")[1].split('"')[0])
-            break
-    return val
+            return float(prov[i].split("=")[1].split('"')[0])
+    raise ValueError(param + " not found in the tree sequence provenance")
 
 
-# read input paths from a preprocessed, hierarchical folder
+# read the tree sequence catalog into a dict of columns; row i is tree i
+def read_catalog(path):
+    trees, target_paths, values = [], [], []
+    with open(path) as infile:
+        for line in infile:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            trees.append(fields[0])
+            target_paths.append(fields[1])
+            values.append(list(map(float, fields[2:])))
+    values = np.array(values, dtype=float).reshape(-1, 5)
+    catalog = {"tree": trees, "target_path": target_paths}
+    for c, name in enumerate(
+        ["target", "W", "sigma", "num_individuals", "generation"]
+    ):
+        catalog[name] = values[:, c]
+    return catalog
+
+
+# read the index of a shard folder: example names, and the next shard id
+def read_shard_index(shard_dir):
+    names, next_shard = {}, 0
+    if os.path.isfile(os.path.join(shard_dir, "index.txt")):
+        with open(os.path.join(shard_dir, "index.txt")) as infile:
+            for line in infile:
+                name, shard, offset = line.strip().split("\t")
+                names[name] = (int(shard), int(offset))
+                next_shard = max(next_shard, int(shard) + 1)
+    return names, next_shard
+
+
+# read the manifest of a preprocessed split, one list of fields per example
+def read_manifest(path):
+    entries = []
+    manifest = os.path.join(path, "manifest.txt")
+    if os.path.isfile(manifest):
+        with open(manifest) as infile:
+            for line in infile:
+                if line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 8 and len(fields[7]) == 8:
+                    entries.append(fields)  # (skips a line cut off mid-write)
+    return entries
+
+
+# the latest manifest entry of each example, ordered by seed, tree and draw
+# (not by the order in which parallel workers happened to finish)
+def latest_entries(entries):
+    latest = {}
+    for fields in entries:  # (an example redone after a crash is listed last)
+        latest[(fields[0], fields[1])] = fields
+    return sorted(latest.values(), key=lambda fields: (
+        fields[1], [int(i) for i in fields[0].split("_")]
+    ))
+
+
+# read input paths from a split's manifest; examples packed into shards are
+# given as (shard path, row) instead of a path
+def dict_from_manifest(path, entries):
+    targets, genos, locs = {}, {}, {}
+    for counter, fields in enumerate(latest_entries(entries)):
+        paths = [os.path.join(path, f) for f in fields[2:5]]
+        row = int(fields[5])
+        if row >= 0:
+            paths = [(p, row) for p in paths]
+        genos[counter], locs[counter], targets[counter] = paths
+    return targets, genos, locs
+
+
+# read input paths from a preprocessed, hierarchical folder: from its
+# manifest, or by walking the folder if there's none (older output);
+# examples packed into shards are given as (shard path, row) instead of a path
 def dict_from_preprocessed(path):
+    entries = read_manifest(path)
+    if len(entries) > 0:
+        return dict_from_manifest(path, entries)
     targets, genos, locs, counter = {}, {}, {}, 0
     for root, subdir, files in os.walk(path + "/Targets/"):
         if subdir == []:  # excluding the Targets/ folder itself
@@ -131,4 +207,84 @@ def dict_from_preprocessed(path):
                 genos[counter] = genopath
                 locs[counter] = locpath
                 counter += 1
+    if os.path.isdir(path + "/Shards/"):
+        for seed in sorted(os.listdir(path + "/Shards/")):
+            shard_dir = os.path.join(path, "Shards", seed)
+            names, next_shard = read_shard_index(shard_dir)
+            for shard, offset in names.values():
+                prefix = os.path.join(shard_dir, str(shard))
+                targets[counter] = (prefix + ".targets.npy", offset)
+                genos[counter] = (prefix + ".genos.npy", offset)
+                locs[counter] = (prefix + ".locs.npy", offset)
+                counter += 1
     return targets, genos, locs
+
+
+# load examples from their own .npy files, or rows of a (memory-mapped) shard
+def load_arrays(entries, shards):
+    arrays = [None] * len(entries)
+    shard_rows = {}
+    for i, entry in enumerate(entries):
+        if isinstance(entry, tuple):  # (shard path, row)
+            shard_rows.setdefault(entry[0], []).append((entry[1], i))
+        else:
+            arrays[i] = np.load(entry)
+    for path, rows in shard_rows.items():  # one read per shard
+        if path not in shards:
+            shards[path] = np.load(path, mmap_mode="r")
+        rows.sort()
+        block = shards[path][[row for row, i in rows]]
+        for (row, i), arr in zip(rows, block):
+            arrays[i] = arr
+    return arrays
+
+
+# checksum of a split's examples, from its manifest (including each
+# example's crc32), or from file sizes and times for older output
+def split_fingerprint(path, targets, genos, locs):
+    entries = read_manifest(path)
+    if len(entries) > 0:
+        lines = ["\t".join(fields) for fields in latest_entries(entries)]
+    else:
+        lines = []
+        for ID in sorted(targets):
+            for entry in [targets[ID], genos[ID], locs[ID]]:
+                f = entry[0] if isinstance(entry, tuple) else entry
+                stat = os.stat(f)
+                lines.append(str(entry) + str((stat.st_size, stat.st_mtime)))
+    return "%08x" % zlib.crc32("\n".join(lines).encode())
+
+
+# memory-map the packed arrays of a split, followed by the fingerprint of the
+# split they were packed from; or None if not (completely) packed yet
+def read_packed(pack_dir):
+    packed = []
+    for name in ["targets", "genos", "locs"]:
+        path = os.path.join(pack_dir, name + ".npy")
+        if os.path.isfile(path) is False:
+            return None
+        packed.append(np.load(path, mmap_mode="r"))
+    fingerprint = os.path.join(pack_dir, "fingerprint.txt")
+    if os.path.isfile(fingerprint) is False:
+        return None
+    with open(fingerprint) as infile:
+        packed.append(infile.read().strip())
+    return packed
+
+
+# the source tree sequence of each example in dict_from_preprocessed(), in
+# the same order; repeated draws from one tree are named <tree>_<k>
+def tree_ids_from_preprocessed(path):
+    entries = read_manifest(path)
+    if len(entries) > 0:
+        names = [fields[0] for fields in latest_entries(entries)]
+    else:
+        names = []
+        for root, subdir, files in os.walk(path + "/Targets/"):
+            if subdir == []:
+                names += [f.split(".")[0] for f in files]
+        if os.path.isdir(path + "/Shards/"):
+            for seed in sorted(os.listdir(path + "/Shards/")):
+                shard_dir = os.path.join(path, "Shards", seed)
+                names += list(read_shard_index(shard_dir)[0])
+    return np.array([int(name.split("_")[0]) for name in names])
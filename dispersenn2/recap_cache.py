@@ -0,0 +1,65 @@
+# helper utils for caching recapitated tree sequences on disk
+
+import hashlib
+import msprime
+import os
+import tskit
+
+
+# content-addressed cache key: source file, recombination rate, and seed
+def cache_key(filepath, rho, seed):
+    key = hashlib.sha256()
+    with open(filepath, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            key.update(chunk)
+    key.update(
+        " ".join(map(str, [rho, seed, msprime.__version__])).encode()
+    )  # (a different msprime version might recapitate differently)
+    return key.hexdigest()
+
+
+# load a cached tree sequence, or None if missing
+def cache_load(cache_dir, key):
+    path = os.path.join(cache_dir, key + ".trees")
+    try:
+        ts = tskit.load(path)
+        os.utime(path)  # (modification time tracks last use, for eviction)
+    except (FileNotFoundError, tskit.FileFormatError):
+        return None
+    return ts
+
+
+# store a tree sequence, then evict least recently used entries over the cap
+def cache_store(cache_dir, key, ts, max_gb=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + ".trees")
+    tmp = path + ".tmp" + str(os.getpid())
+    ts.dump(tmp)
+    os.replace(tmp, path)
+    if max_gb is not None:
+        cache_evict(cache_dir, max_gb)
+    return
+
+
+# delete least recently used entries until the cache fits in max_gb
+def cache_evict(cache_dir, max_gb):
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith(".trees"):
+            path = os.path.join(cache_dir, f)
+            try:
+                stats = os.stat(path)
+            except FileNotFoundError:  # (removed by another worker)
+                continue
+            entries.append((stats.st_mtime, stats.st_size, path))
+    entries.sort()
+    total = sum([size for mtime, size, path in entries])
+    for mtime, size, path in entries:
+        if total <= max_gb * 1e9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return
@@ -0,0 +1,114 @@
+# helper utils for writing out data
+
+import numpy as np
+import os
+import zlib
+import threading
+from dispersenn2.read_input import load_arrays
+
+
+# numpy-save an array without ever leaving a partial file at the final path
+def save_atomic(path, arr):
+    if not path.endswith(".npy"):  # (same suffix handling as np.save)
+        path += ".npy"
+    tmp = path + ".tmp" + str(os.getpid())
+    with open(tmp, "wb") as outfile:
+        np.save(outfile, arr)
+    os.replace(tmp, path)
+    return
+
+
+# write a list of (name, genos, locs, target) examples to a single shard,
+# then record each example's row in the shard index
+def write_shard(shard_dir, shard_id, examples):
+    prefix = os.path.join(shard_dir, str(shard_id))
+    names, genos, locs, targets = zip(*examples)
+    save_atomic(prefix + ".genos", np.stack(genos))
+    save_atomic(prefix + ".locs", np.stack(locs))
+    save_atomic(prefix + ".targets", np.array(targets))
+    with open(os.path.join(shard_dir, "index.txt"), "a") as out_f:
+        for offset, name in enumerate(names):
+            print(name, shard_id, offset, sep="\t", file=out_f)
+    return
+
+
+# one manifest line per example: name, seed, genos/locs/target paths relative
+# to the split folder, row in the shard (-1 for its own file), genos shape
+# and a crc32 of the genotypes
+def manifest_line(name, seed, paths, row, geno_mat):
+    shape = "x".join(str(d) for d in geno_mat.shape)
+    checksum = zlib.crc32(np.ascontiguousarray(geno_mat).tobytes())
+    return "\t".join([name, str(seed)] + list(paths)
+                     + [str(row), shape, "%08x" % checksum])
+
+
+# open a split's manifest for appending, starting it with a header line
+def open_manifest(path):
+    manifest = os.path.join(path, "manifest.txt")
+    new = os.path.isfile(manifest) is False
+    out_f = open(manifest, "a")
+    if new:
+        print("#name\tseed\tgenos\tlocs\ttarget\trow\tshape\tcrc32",
+              file=out_f, flush=True)
+    return out_f
+
+
+# write the tree sequence catalog: one row per tree, in tree list order
+def write_catalog(path, entries):
+    tmp = path + ".tmp" + str(os.getpid())
+    with open(tmp, "w") as out_f:
+        print("#tree\ttarget_path\ttarget\tW\tsigma\tnum_individuals"
+              "\tgeneration", file=out_f)
+        for entry in entries:
+            print(*entry, sep="\t", file=out_f)
+    os.replace(tmp, path)
+    return
+
+
+# copy every example of a split into one memory-mappable array per input;
+# row i holds example ID i. The fingerprint of the split is written last
+def pack_split(pack_dir, targets, genos, locs, fingerprint,
+               chunk_size=1000):
+    os.makedirs(pack_dir, exist_ok=True)
+    if os.path.isfile(os.path.join(pack_dir, "fingerprint.txt")):
+        os.remove(os.path.join(pack_dir, "fingerprint.txt"))
+    ids = sorted(targets)
+    shards = {}
+    for name, entries in [("targets", targets),
+                          ("genos", genos),
+                          ("locs", locs)]:
+        first = load_arrays([entries[ids[0]]], shards)[0]
+        dtype = first.dtype
+        if name == "genos" and dtype != np.uint8:  # (unless bit-packed)
+            dtype = np.int8  # (genotypes are small integers)
+        path = os.path.join(pack_dir, name + ".npy")
+        tmp = path + ".tmp" + str(os.getpid())
+        packed = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=dtype, shape=(len(ids),) + first.shape
+        )
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            packed[start:start + len(chunk)] = np.stack(
+                load_arrays([entries[ID] for ID in chunk], shards)
+            )
+        packed.flush()
+        del packed
+        os.replace(tmp, path)
+    path = os.path.join(pack_dir, "fingerprint.txt")
+    tmp = path + ".tmp" + str(os.getpid())
+    with open(tmp, "w") as out_f:
+        print(fingerprint, file=out_f)
+    os.replace(tmp, path)
+    return
+
+
+# write strings from a queue to a file in a background thread, until None
+def start_writer(path, lines):
+    def write():
+        with open(path, "w") as out_f:
+            for chunk in iter(lines.get, None):
+                out_f.write(chunk)
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    return writer